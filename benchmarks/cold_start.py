@@ -0,0 +1,135 @@
+"""
+Import time of each cloud function, the part of the cold start that the code controls.
+
+Each function is imported by a new interpreter with -X importtime, like a new instance
+does before it serves its first request, and the median of the runs is compared with the
+target of the function. Exits with an error when a function is over its target.
+
+    python benchmarks/cold_start.py --repeat 5
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+from run import CLOUD_FUNCTIONS_DIR, PROJECT_ID, STAGES
+
+# Median import time of `main`, in seconds. The google.cloud clients and the secret manager
+# are imported when they are first used, so they are not counted here.
+COLD_START_TARGETS_SECONDS = {
+    'cf_extract': 0.6,
+    'cf_create_dimensions': 0.5,
+    'cf_create_plataforms_dimension': 0.5,
+    'cf_create_artists_dimension': 0.5,
+    'cf_create_tracks_dimension': 0.5,
+    'cf_create_playlists_dimension': 0.5,
+    'cf_transform': 0.5,
+}
+
+TOP_IMPORTS_COUNT = 5
+
+
+def parse_import_times(output):
+    """
+    Returns the cumulative seconds of `main` and of each module it imports directly, from
+    the -X importtime report.
+    """
+    # A module is reported after the ones it imports, so the children of `main` are the
+    # modules one level down since the previous top level one
+    children = {}
+
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative_us, name = line.split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2 # The name is indented by two spaces a level
+        seconds = int(cumulative_us) / 1_000_000
+
+        if depth == 1:
+            children[name.strip()] = seconds
+        elif depth == 0:
+            if name.strip() == 'main':
+                return {'main': seconds, **children}
+
+            children = {}
+
+    raise Exception('main is not in the import time report')
+
+def import_function(function_name):
+    environment = {
+        **os.environ,
+        'PROJECT_ID': PROJECT_ID,
+        'SONGS_SECRET_NAME': 'benchmark',
+        'PYTHONPATH': os.pathsep.join([os.path.join(CLOUD_FUNCTIONS_DIR, function_name), CLOUD_FUNCTIONS_DIR]),
+        **STAGES[function_name],
+    }
+
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'],
+        cwd=os.path.join(CLOUD_FUNCTIONS_DIR, function_name),
+        env=environment,
+        capture_output=True,
+        text=True,
+    )
+
+    if process.returncode != 0:
+        raise Exception(f'The import of {function_name} failed: {process.stderr[-2000:]}')
+
+    return parse_import_times(process.stderr)
+
+def run_cold_start_benchmark(args):
+    results = []
+
+    for function_name in args.functions:
+        runs = [import_function(function_name) for _ in range(args.repeat)]
+        import_seconds = statistics.median(run['main'] for run in runs)
+
+        # The imports of the median run that take the longest
+        median_run = min(runs, key=lambda run: abs(run['main'] - import_seconds))
+        top_imports = sorted(
+            ((name, seconds) for name, seconds in median_run.items() if name != 'main'),
+            key=lambda item: item[1],
+            reverse=True,
+        )[:TOP_IMPORTS_COUNT]
+
+        target_seconds = COLD_START_TARGETS_SECONDS[function_name]
+        results.append({
+            'function': function_name,
+            'import_seconds': import_seconds,
+            'target_seconds': target_seconds,
+            'within_target': import_seconds <= target_seconds,
+            'top_imports': dict(top_imports),
+        })
+
+        print(
+            f"{function_name:<32} {import_seconds:>6.3f}s import {target_seconds:>6.3f}s target "
+            f"{'ok' if import_seconds <= target_seconds else 'OVER':<4}  "
+            + ', '.join(f'{name} {seconds:.3f}s' for name, seconds in top_imports)
+        )
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'parameters': vars(args), 'results': results}, file, indent=2)
+
+        print(f'\nResults written to {args.output}')
+
+    return results
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Import time of the cloud functions')
+
+    parser.add_argument('--functions', nargs='+', choices=list(COLD_START_TARGETS_SECONDS), default=list(COLD_START_TARGETS_SECONDS))
+    parser.add_argument('--repeat', type=int, default=5, help='Imports of each function, the median is kept')
+    parser.add_argument('--output', help='JSON file for the results')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    results = run_cold_start_benchmark(get_arguments())
+
+    if not all(result['within_target'] for result in results):
+        sys.exit(1)
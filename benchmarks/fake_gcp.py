@@ -0,0 +1,370 @@
+import io
+import os
+import re
+import json
+import threading
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+TERRAFORM_BIGQUERY_FILE = os.path.join(os.path.dirname(__file__), '..', 'terraform', 'bigquery.tf')
+
+
+###################################################################################
+# Cloud Storage
+###################################################################################
+
+class FakeBlobWriter:
+    # Written under a temporary name and renamed on close, like a resumable upload that is only
+    # visible after it is finalized
+    def __init__(self, blob):
+        self.blob = blob
+        self.temporary_path = f'{blob.path}.{threading.get_ident()}.uploading'
+        self.file = open(self.temporary_path, 'wb')
+
+    def write(self, data):
+        self.blob.bucket.client.count('bytes_written', len(data))
+        return self.file.write(data)
+
+    def flush(self):
+        pass
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.file.tell()
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def close(self):
+        if self.file.closed:
+            return
+
+        self.file.close()
+        os.replace(self.temporary_path, self.blob.path)
+        self.blob.save_metadata()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+class FakeBlob:
+    def __init__(self, bucket, name, chunk_size=None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+        self.path = os.path.join(bucket.path, name)
+        self.content_encoding = None
+        self.content_type = None
+        self.generation = None
+
+    @property
+    def metadata_path(self):
+        return f'{self.path}.metadata.json'
+
+    def save_metadata(self):
+        with open(self.metadata_path, 'w') as file:
+            json.dump({'content_encoding': self.content_encoding, 'content_type': self.content_type}, file)
+
+    def reload(self):
+        if not os.path.exists(self.path):
+            raise NotFound(f'{self.bucket.name}/{self.name}')
+
+        with open(self.metadata_path) as file:
+            metadata = json.load(file)
+
+        self.content_encoding = metadata['content_encoding']
+        self.content_type = metadata['content_type']
+        self.generation = os.stat(self.path).st_mtime_ns
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def delete(self):
+        if not os.path.exists(self.path):
+            raise NotFound(f'{self.bucket.name}/{self.name}')
+
+        os.remove(self.path)
+        os.remove(self.metadata_path)
+
+    def open(self, mode='r', content_type=None, ignore_flush=False, raw_download=False, chunk_size=None):
+        if mode == 'wb':
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.content_type = content_type
+            return FakeBlobWriter(self)
+
+        if mode == 'rb':
+            self.reload()
+            self.bucket.client.count('bytes_read', os.path.getsize(self.path))
+            return open(self.path, 'rb')
+
+        raise ValueError(f'Mode not supported by the fake blob: {mode}')
+
+    def upload_from_string(self, data, content_type='text/plain'):
+        with self.open('wb', content_type=content_type) as file:
+            file.write(data.encode('utf-8') if isinstance(data, str) else data)
+
+    def upload_from_file(self, file_obj, content_type=None):
+        self.upload_from_string(file_obj.read(), content_type=content_type)
+
+    def upload_from_filename(self, filename, content_type=None):
+        with open(filename, 'rb') as source:
+            self.upload_from_string(source.read(), content_type=content_type)
+
+    def download_as_bytes(self):
+        with self.open('rb') as file:
+            return file.read()
+
+    def download_as_text(self):
+        return self.download_as_bytes().decode('utf-8')
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.root, name)
+
+    def blob(self, blob_name, chunk_size=None):
+        return FakeBlob(self, blob_name, chunk_size=chunk_size)
+
+    def get_blob(self, blob_name):
+        blob = self.blob(blob_name)
+
+        try:
+            blob.reload()
+        except NotFound:
+            return None
+
+        return blob
+
+    def list_blobs(self, prefix=''):
+        names = []
+
+        for directory, _, files in os.walk(self.path):
+            for file in files:
+                if file.endswith('.metadata.json') or file.endswith('.uploading'):
+                    continue
+
+                names.append(os.path.relpath(os.path.join(directory, file), self.path).replace(os.sep, '/'))
+
+        return [self.get_blob(name) for name in sorted(names) if name.startswith(prefix)]
+
+class FakeStorageClient:
+    """
+    Stand-in for `storage.Client` that keeps the buckets in a local directory, so the
+    stages of the benchmark, which run in separate processes, see the same objects.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.counters = {}
+        self._counters_lock = threading.Lock()
+
+    def count(self, counter, value=1):
+        with self._counters_lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def bucket(self, bucket_name):
+        return FakeBucket(self, bucket_name)
+
+    def get_bucket(self, bucket_name):
+        return self.bucket(bucket_name)
+
+
+###################################################################################
+# BigQuery
+###################################################################################
+
+def get_terraform_schemas(terraform_file=TERRAFORM_BIGQUERY_FILE):
+    """
+    Returns {dataset.table: [SchemaField]} of the tables declared in the Terraform, so
+    the fake tables always have the same schemas as the real ones.
+    """
+    with open(terraform_file) as file:
+        terraform = file.read()
+
+    schemas = {}
+
+    table_pattern = r'resource "google_bigquery_table" "\w+" \{.*?dataset_id\s*=\s*google_bigquery_dataset\.(\w+)\.dataset_id.*?table_id\s*=\s*"(\w+)".*?<<SCHEMA(.*?)SCHEMA\n'
+    for dataset, table, schema in re.findall(table_pattern, terraform, re.DOTALL):
+        schemas[f'{dataset}.{table}'] = [
+            bigquery.SchemaField(field['name'], field['type'], mode=field.get('mode', 'NULLABLE'))
+            for field in json.loads(schema)
+        ]
+
+    return schemas
+
+class FakeJob:
+    def __init__(self, num_dml_affected_rows=None):
+        self.num_dml_affected_rows = num_dml_affected_rows
+
+    def result(self):
+        return self
+
+class FakeRowIterator:
+    def __init__(self, table):
+        self.table = table
+
+    def to_arrow(self, bqstorage_client=None, create_bqstorage_client=True):
+        return self.table
+
+    def to_dataframe(self, bqstorage_client=None, create_bqstorage_client=True):
+        return self.table.to_pandas()
+
+class FakeBigQueryClient:
+    """
+    Stand-in for `bigquery.Client` that keeps each table as a Parquet file in a local
+    directory.
+
+    Only the MERGE statements written by `songs_common.warehouse` are understood: the
+    staging rows replace the rows with the same keys. The partition and cluster filters
+    are ignored, which gives the same result on the fake tables.
+    """
+
+    project = 'benchmark'
+
+    def __init__(self, root, schemas=None, storage_client=None):
+        self.root = root
+        self.schemas = schemas if schemas is not None else get_terraform_schemas()
+        self.storage_client = storage_client # Where the gs:// URIs of the loads are read from
+        self.counters = {}
+        self._counters_lock = threading.Lock()
+
+        os.makedirs(root, exist_ok=True)
+
+    def count(self, counter, value=1):
+        with self._counters_lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def get_table_path(self, table_id):
+        return os.path.join(self.root, f'{table_id}.parquet')
+
+    def get_appended_paths(self, table_id):
+        # The rows appended to a table are kept in files of their own, so an append doesn't rewrite the table
+        prefix = f'{table_id}.append-'
+
+        return sorted(os.path.join(self.root, name) for name in os.listdir(self.root) if name.startswith(prefix))
+
+    def read_dataframe(self, table_id):
+        paths = [path for path in [self.get_table_path(table_id)] if os.path.exists(path)] + self.get_appended_paths(table_id)
+
+        if not paths:
+            return pd.DataFrame(columns=[field.name for field in self.schemas[table_id]])
+
+        return pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+
+    def write_dataframe(self, df, table_id):
+        for path in self.get_appended_paths(table_id):
+            os.remove(path)
+
+        df.to_parquet(self.get_table_path(table_id), index=False)
+
+    def write_parquet(self, data, table_id, append=False):
+        if append:
+            path = os.path.join(self.root, f'{table_id}.append-{len(self.get_appended_paths(table_id)):06d}.parquet')
+        else:
+            for path in self.get_appended_paths(table_id):
+                os.remove(path)
+
+            path = self.get_table_path(table_id)
+
+        with open(path, 'wb') as file:
+            file.write(data)
+
+    def get_table(self, table_id):
+        if table_id not in self.schemas:
+            raise NotFound(f'Table {table_id}')
+
+        return bigquery.Table(f'benchmark.{table_id}', schema=self.schemas[table_id])
+
+    def create_table(self, table):
+        self.schemas[f'{table.dataset_id}.{table.table_id}'] = list(table.schema)
+        return table
+
+    def update_table(self, table, fields):
+        return table
+
+    def delete_table(self, table_id, not_found_ok=False):
+        self.schemas.pop(table_id, None)
+
+        for path in [self.get_table_path(table_id), *self.get_appended_paths(table_id)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def load_parquet(self, data, table_id, job_config):
+        if job_config.source_format != 'PARQUET':
+            raise NotImplementedError(f'Source format not supported by the fake BigQuery: {job_config.source_format}')
+
+        if job_config.schema:
+            self.schemas[table_id] = list(job_config.schema)
+
+        self.count('rows_loaded', pq.read_metadata(io.BytesIO(data)).num_rows)
+        self.write_parquet(data, table_id, append=job_config.write_disposition == 'WRITE_APPEND')
+
+        return FakeJob()
+
+    def load_table_from_file(self, file_obj, table_id, job_config=None):
+        return self.load_parquet(file_obj.read(), table_id, job_config)
+
+    def load_table_from_uri(self, source_uris, table_id, job_config=None):
+        bucket_name, blob_name = source_uris[len('gs://'):].split('/', 1)
+
+        return self.load_parquet(self.storage_client.bucket(bucket_name).blob(blob_name).download_as_bytes(), table_id, job_config)
+
+    def query(self, query):
+        merge = re.search(r'MERGE `([\w.]+)` T\s+USING `([\w.]+)` S', query)
+        if merge is None:
+            raise NotImplementedError(f'Query not supported by the fake BigQuery: {query}')
+
+        target_table, staging_table = merge.groups()
+        key_columns = re.findall(r'T\.(\w+) IS NOT DISTINCT FROM S\.\w+', query)
+
+        target = self.read_dataframe(target_table)
+        staging = self.read_dataframe(staging_table)
+
+        merged = pd.concat([target, staging], ignore_index=True).drop_duplicates(key_columns, keep='last')
+        self.write_dataframe(merged, target_table)
+        self.count('rows_merged', len(staging))
+
+        return FakeJob(num_dml_affected_rows=len(staging))
+
+    def list_rows(self, table, selected_fields=None):
+        table_id = f'{table.dataset_id}.{table.table_id}' if isinstance(table, bigquery.Table) else table
+
+        columns = [field.name for field in selected_fields] if selected_fields else None
+        arrow_table = pa.Table.from_pandas(self.read_dataframe(table_id), preserve_index=False)
+
+        return FakeRowIterator(arrow_table.select(columns) if columns else arrow_table)
+
+class FakeBigQueryReadClient:
+    # The fake tables are read by FakeRowIterator, the client is only passed around
+    pass
+
+
+def install_fake_clients(root):
+    """
+    Puts the fake clients in the process-wide clients of `songs_common.gcp`, so every
+    reader and writer of the functions uses them.
+    """
+    from songs_common import gcp
+
+    storage_client = FakeStorageClient(os.path.join(root, 'storage'))
+
+    clients = {
+        'storage': storage_client,
+        'bigquery': FakeBigQueryClient(os.path.join(root, 'bigquery'), storage_client=storage_client),
+        'bigquery_storage': FakeBigQueryReadClient(),
+    }
+
+    with gcp._CLIENTS_LOCK:
+        gcp._CLIENTS.update(clients)
+
+    return clients
@@ -0,0 +1,330 @@
+import json
+import hashlib
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Spotify sends the markets of every track and album unless `fields` leaves them out
+MARKETS = [f'{first}{second}' for first in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ' for second in 'ABCDEFG'][:180]
+
+
+def parse_fields(fields):
+    """
+    Parses a Spotify `fields` filter, e.g. `items(added_at,track(id)),next`, into
+    {'items': {'added_at': {}, 'track': {'id': {}}}, 'next': {}}.
+    """
+    def parse(position):
+        tree = {}
+        key = ''
+
+        while position < len(fields):
+            character = fields[position]
+
+            if character == '(':
+                tree[key], position = parse(position + 1)
+                key = ''
+            elif character == ')':
+                break
+            elif character == ',':
+                if key:
+                    tree[key] = {}
+                key = ''
+            else:
+                key += character
+
+            position += 1
+
+        if key:
+            tree[key] = {}
+
+        return tree, position
+
+    return parse(0)[0]
+
+def apply_fields(value, tree):
+    if not tree:
+        return value
+
+    if isinstance(value, list):
+        return [apply_fields(element, tree) for element in value]
+
+    if isinstance(value, dict):
+        return {key: apply_fields(value[key], subtree) for key, subtree in tree.items() if key in value}
+
+    return value
+
+
+class SyntheticSpotify:
+    """
+    Synthetic Spotify catalog of `users` users with `playlists_per_user` playlists of
+    `tracks_per_playlist` tracks each.
+
+    Nothing is kept in memory: every item is generated from the seed and its position,
+    so the same parameters always give the same responses, whatever the scale.
+    """
+
+    def __init__(self, users=10, playlists_per_user=5, tracks_per_playlist=100, artists=None, albums=None, seed=42):
+        self.users = users
+        self.playlists_per_user = playlists_per_user
+        self.tracks_per_playlist = tracks_per_playlist
+        self.seed = seed
+
+        # Real libraries repeat a lot of tracks, artists and albums between playlists
+        total_tracks = users * playlists_per_user * tracks_per_playlist
+        self.catalog_tracks = max(1, total_tracks // 3)
+        self.artists = artists or max(1, self.catalog_tracks // 10)
+        self.albums = albums or max(1, self.catalog_tracks // 8)
+
+    def user_id(self, user_index):
+        return f'user{user_index:06d}'
+
+    def get_users(self):
+        return [
+            {
+                'dim_user_id': f'dim-{self.user_id(user_index)}',
+                'name': f'User {user_index}',
+                'spotify_id': self.user_id(user_index),
+            }
+            for user_index in range(self.users)
+        ]
+
+    def get_playlist(self, user_index, playlist_index):
+        playlist_id = f'pl{user_index:06d}x{playlist_index:04d}'
+
+        return {
+            'id': playlist_id,
+            'name': f'Playlist {playlist_index} of user {user_index}',
+            'snapshot_id': f'snap-{self.seed}-{playlist_id}',
+            'owner': {'id': self.user_id(user_index)},
+            'collaborative': False,
+            'public': playlist_index % 2 == 0,
+            'tracks': {'total': self.tracks_per_playlist},
+        }
+
+    def get_artist(self, artist_index):
+        return {'id': f'ar{artist_index:08d}', 'name': f'Artist {artist_index}'}
+
+    def get_album(self, album_index):
+        album_id = f'al{album_index:08d}'
+
+        return {
+            'id': album_id,
+            'name': f'Album {album_index}',
+            'release_date': f'{1970 + album_index % 55}-{1 + album_index % 12:02d}-{1 + album_index % 28:02d}',
+            'total_tracks': 8 + album_index % 12,
+            'images': [
+                {'url': f'https://i.scdn.co/image/{album_id}/{size}', 'height': size, 'width': size}
+                for size in [640, 300, 64]
+            ],
+            'available_markets': MARKETS,
+            'external_urls': {'spotify': f'https://open.spotify.com/album/{album_id}'},
+            'href': f'https://api.spotify.com/v1/albums/{album_id}',
+            'uri': f'spotify:album:{album_id}',
+        }
+
+    def get_track(self, track_index):
+        rng = random.Random(f'{self.seed}:track:{track_index}')
+        artists = rng.sample(range(self.artists), k=min(self.artists, rng.choice([1, 1, 1, 2, 3])))
+
+        track_id = f'tr{track_index:08d}'
+
+        return {
+            'id': track_id,
+            'name': f'Track {track_index}',
+            'duration_ms': rng.randint(90_000, 420_000),
+            'explicit': rng.random() < 0.2,
+            'album': self.get_album(track_index % self.albums),
+            'artists': [self.get_artist(artist_index) for artist_index in artists],
+            'available_markets': MARKETS,
+            'disc_number': 1,
+            'track_number': 1 + track_index % 12,
+            'popularity': track_index % 101,
+            'preview_url': f'https://p.scdn.co/mp3-preview/{track_id}',
+            'external_ids': {'isrc': f'BR{track_index:010d}'},
+            'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'},
+            'href': f'https://api.spotify.com/v1/tracks/{track_id}',
+            'uri': f'spotify:track:{track_id}',
+        }
+
+    def get_playlist_item(self, playlist_id, position):
+        rng = random.Random(f'{self.seed}:{playlist_id}:{position}')
+
+        return {
+            'added_at': f'20{rng.randint(15, 24)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:00:00Z',
+            'is_local': False,
+            'added_by': {'id': 'user', 'type': 'user', 'uri': 'spotify:user:user'},
+            'primary_color': None,
+            'video_thumbnail': {'url': None},
+            'track': self.get_track(rng.randrange(self.catalog_tracks)),
+        }
+
+    def get_full_artist(self, artist_id):
+        artist_index = int(artist_id[len('ar'):])
+
+        return {
+            **self.get_artist(artist_index),
+            'type': 'artist',
+            'genres': [f'genre {artist_index % 40}'],
+            'popularity': artist_index % 101,
+            'followers': {'href': None, 'total': artist_index * 7},
+            'images': [{'url': f'https://i.scdn.co/image/{artist_id}', 'height': 640, 'width': 640}],
+        }
+
+    def get_full_album(self, album_id):
+        album_index = int(album_id[len('al'):])
+
+        return {
+            **self.get_album(album_index),
+            'type': 'album',
+            'album_type': 'album',
+            'release_date_precision': 'day',
+            'label': f'Label {album_index % 25}',
+            'popularity': album_index % 101,
+            'artists': [self.get_artist(album_index % self.artists)],
+        }
+
+    def get_several(self, get_item, ids, prefix, catalog_size):
+        # Like Spotify, an unknown id gives a null
+        return [
+            get_item(item_id) if item_id.startswith(prefix) and item_id[len(prefix):].isdigit() and int(item_id[len(prefix):]) < catalog_size else None
+            for item_id in ids
+        ]
+
+    def get_page(self, items, total, limit, offset, url):
+        next_offset = offset + limit
+
+        return {
+            'items': items,
+            'total': total,
+            'limit': limit,
+            'offset': offset,
+            'next': f'{url}?limit={limit}&offset={next_offset}' if next_offset < total else None,
+        }
+
+    def get_user_playlists(self, user_id, limit, offset):
+        user_index = int(user_id[len('user'):])
+        playlist_indices = range(offset, min(offset + limit, self.playlists_per_user))
+
+        items = [self.get_playlist(user_index, playlist_index) for playlist_index in playlist_indices]
+        return self.get_page(items, self.playlists_per_user, limit, offset, f'/v1/users/{user_id}/playlists')
+
+    def get_playlist_tracks(self, playlist_id, limit, offset):
+        positions = range(offset, min(offset + limit, self.tracks_per_playlist))
+
+        items = [self.get_playlist_item(playlist_id, position) for position in positions]
+        return self.get_page(items, self.tracks_per_playlist, limit, offset, f'/v1/playlists/{playlist_id}/tracks')
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like the real API
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+
+        # The generated responses never change, so a revalidation always gets a 304, like an unchanged catalog
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self.server.count_request('not_modified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if status == 200:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.count_request('token')
+
+        if self.path != '/api/token':
+            return self.send_json(404, {'error': 'not found'})
+
+        self.send_json(200, {'access_token': 'benchmark-token', 'token_type': 'Bearer', 'expires_in': 3600})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+
+        limit = int(query.get('limit', ['20'])[0])
+        offset = int(query.get('offset', ['0'])[0])
+
+        if self.server.latency_seconds:
+            time.sleep(self.server.latency_seconds)
+
+        spotify = self.server.spotify
+
+        if parts[:2] == ['v1', 'users'] and len(parts) == 4 and parts[3] == 'playlists':
+            self.server.count_request('playlists')
+            return self.send_json(200, spotify.get_user_playlists(parts[2], limit, offset))
+
+        if parts[:2] == ['v1', 'playlists'] and len(parts) == 4 and parts[3] == 'tracks':
+            self.server.count_request('tracks')
+            page = spotify.get_playlist_tracks(parts[2], limit, offset)
+
+            if query.get('fields', [''])[0]:
+                page = apply_fields(page, parse_fields(query['fields'][0]))
+
+            return self.send_json(200, page)
+
+        if parts == ['v1', 'artists'] and 'ids' in query:
+            self.server.count_request('artists')
+            artist_ids = query['ids'][0].split(',')[:50]
+            return self.send_json(200, {'artists': spotify.get_several(spotify.get_full_artist, artist_ids, 'ar', spotify.artists)})
+
+        if parts == ['v1', 'albums'] and 'ids' in query:
+            self.server.count_request('albums')
+            album_ids = query['ids'][0].split(',')[:20]
+            return self.send_json(200, {'albums': spotify.get_several(spotify.get_full_album, album_ids, 'al', spotify.albums)})
+
+        self.server.count_request('not_found')
+        self.send_json(404, {'error': {'status': 404, 'message': 'Non existing path'}})
+
+
+class FakeSpotifyServer(ThreadingHTTPServer):
+    """
+    Local HTTP server that answers the Spotify endpoints used by cf_extract with the
+    responses of `spotify`. `latency_ms` is added to every API call to mimic the network.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, spotify, latency_ms=0, host='127.0.0.1', port=0):
+        super().__init__((host, port), FakeSpotifyHandler)
+
+        self.spotify = spotify
+        self.latency_seconds = latency_ms / 1000
+        self.request_counts = {}
+        self._counts_lock = threading.Lock()
+
+    def count_request(self, endpoint):
+        with self._counts_lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    @property
+    def token_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/api/token'
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+        return self
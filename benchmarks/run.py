@@ -0,0 +1,312 @@
+"""
+Offline benchmark of the ETL.
+
+Runs cf_extract against a local fake of the Spotify API, then the dimension functions and
+cf_transform, with the storage and BigQuery clients replaced by local stand-ins. Each
+stage runs in its own process, like in the cloud, and reports its wall time, peak RSS and
+records/sec. Nothing goes to the network.
+
+    python benchmarks/run.py --users 50 --playlists-per-user 10 --tracks-per-playlist 200
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import importlib
+import subprocess
+import pyarrow.parquet as pq
+from datetime import date, timedelta
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+CLOUD_FUNCTIONS_DIR = os.path.join(BENCHMARKS_DIR, '..', 'cloud-functions')
+
+PROJECT_ID = 'benchmark'
+
+# Same environment as the Terraform
+STAGES = {
+    'cf_extract': {'DATASET_ID': 'prep_songs_dimensions', 'TABLE_ID': 'dim_user'},
+    'cf_create_dimensions': {'DATASET_ID': 'prep_songs_dimensions'},
+    'cf_create_plataforms_dimension': {'DATASET_ID': 'prep_songs_dimensions', 'TABLE_ID': 'dim_platform'},
+    'cf_create_artists_dimension': {'DATASET_ID': 'prep_songs_dimensions', 'TABLE_ID': 'dim_artist'},
+    'cf_create_tracks_dimension': {'DATASET_ID': 'prep_songs_dimensions', 'TABLE_ID': 'dim_track'},
+    'cf_create_playlists_dimension': {'DATASET_ID': 'prep_songs_dimensions', 'TABLE_ID': 'dim_playlist'},
+    'cf_transform': {'DATASET_ID': 'prep_songs_facts', 'TABLE_ID': 'fact_songs'},
+}
+
+# Same order as the workflow, the functions of each dimension can still be run with --stages
+WORKFLOW_STAGES = ['cf_extract', 'cf_create_dimensions', 'cf_transform']
+
+
+###################################################################################
+# Stage, runs in the child process
+###################################################################################
+
+def get_peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports it in KB and macOS in bytes
+    return peak_rss / 1024 / 1024 if sys.platform == 'darwin' else peak_rss / 1024
+
+def count_parquet_rows_written_since(root, since, part_index):
+    rows = 0
+
+    for directory, _, files in os.walk(root):
+        for file in files:
+            path = os.path.join(directory, file)
+
+            # The shards run at the same time, each one only counts its own parts
+            if file == f'part-{part_index:04d}.parquet' and os.stat(path).st_mtime_ns >= since:
+                rows += pq.read_metadata(path).num_rows
+
+    return rows
+
+class BenchmarkRequest:
+    # The part of the flask request read by the functions
+    def __init__(self, payload=None):
+        self.payload = payload
+
+    def get_json(self, silent=False):
+        return self.payload
+
+def run_stage(args):
+    os.environ.update({
+        'PROJECT_ID': PROJECT_ID,
+        'SONGS_SECRET_NAME': 'benchmark',
+        'SPOTIFY_MAX_WORKERS': str(args.max_workers),
+        'LANDING_CACHE_DIR': os.path.join(args.data_dir, 'cache', args.stage), # Each function has its own /tmp
+        'NO_PROXY': '127.0.0.1,localhost',
+        'EXTRACT_TIME_BUDGET_SECONDS': str(args.extract_time_budget),
+        'CHECKPOINT_INTERVAL_SECONDS': str(args.checkpoint_interval),
+        'FACT_MEMORY_CEILING_MB': str(args.fact_memory_ceiling_mb),
+        **STAGES[args.stage],
+    })
+
+    sys.path[0:0] = [os.path.join(CLOUD_FUNCTIONS_DIR, args.stage), CLOUD_FUNCTIONS_DIR]
+
+    from fake_gcp import install_fake_clients
+
+    import_started_at = time.perf_counter()
+    clients = install_fake_clients(args.data_dir)
+    function = importlib.import_module('main')
+    import_seconds = time.perf_counter() - import_started_at
+
+    # The cache of the shard is loaded by main, once SHARD is set
+    if args.stage == 'cf_extract':
+        function.SPOTIFY_CLIENT = function.SpotifyClient(
+            get_credentials=lambda: {'spotify_client_id': 'benchmark', 'spotify_client_secret': 'benchmark'},
+            pool_size=function.SPOTIFY_MAX_WORKERS,
+            max_retries=function.SPOTIFY_MAX_RETRIES,
+            base_url=args.spotify_url,
+            token_url=args.token_url,
+        )
+
+    started_at_ns = time.time_ns()
+    started_at = time.perf_counter()
+    invocations = 1
+
+    payload = {'shard': {'index': args.shard_index, 'count': args.shards}}
+
+    if args.backfill_days > 1 and args.stage != 'cf_extract':
+        payload['backfill'] = {'start_date': str(date.today() - timedelta(days=args.backfill_days - 1)), 'end_date': str(date.today())}
+
+    request = BenchmarkRequest(payload)
+
+    # Like the workflow, cf_extract is invoked again while it reports that it is incomplete
+    while isinstance(response := function.main(request), dict) and response.get('status') == 'incomplete':
+        invocations += 1
+
+    wall_seconds = time.perf_counter() - started_at
+
+    # The extraction is measured by the rows landed, the other stages by the rows loaded
+    if args.stage == 'cf_extract':
+        records = count_parquet_rows_written_since(clients['storage'].root, started_at_ns, args.shard_index)
+    else:
+        records = clients['bigquery'].counters.get('rows_loaded', 0)
+
+    result = {
+        'stage': args.stage,
+        'shard_index': args.shard_index,
+        'wall_seconds': wall_seconds,
+        'invocations': invocations,
+        'import_seconds': import_seconds,
+        'peak_rss_mb': get_peak_rss_mb(),
+        'records': records,
+        'records_per_second': records / wall_seconds if wall_seconds else 0,
+        'storage': clients['storage'].counters,
+        'bigquery': clients['bigquery'].counters,
+    }
+
+    with open(args.result_file, 'w') as file:
+        json.dump(result, file)
+
+
+###################################################################################
+# Runner
+###################################################################################
+
+def seed_dim_user(data_dir, spotify):
+    import pandas as pd
+    from fake_gcp import FakeBigQueryClient
+
+    client = FakeBigQueryClient(os.path.join(data_dir, 'bigquery'))
+    client.write_dataframe(pd.DataFrame(spotify.get_users()), 'prep_songs_dimensions.dim_user')
+
+def copy_landing_to_previous_days(data_dir, days):
+    # As if the same data had been extracted on each of the `days` up to today
+    landing_dir = os.path.join(data_dir, 'storage', f'landing-{PROJECT_ID}', 'spotify')
+
+    for dataset in os.listdir(landing_dir):
+        source = os.path.join(landing_dir, dataset, str(date.today()))
+
+        for offset in range(1, days):
+            destination = os.path.join(landing_dir, dataset, str(date.today() - timedelta(days=offset)))
+
+            if os.path.isdir(source) and not os.path.exists(destination):
+                shutil.copytree(source, destination)
+
+def run_benchmark(args):
+    from fake_spotify import SyntheticSpotify, FakeSpotifyServer
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='songs-etl-benchmark-')
+
+    spotify = SyntheticSpotify(
+        users=args.users,
+        playlists_per_user=args.playlists_per_user,
+        tracks_per_playlist=args.tracks_per_playlist,
+        seed=args.seed,
+    )
+    seed_dim_user(data_dir, spotify)
+
+    server = FakeSpotifyServer(spotify, latency_ms=args.latency_ms).start()
+
+    print(f'Benchmark data in {data_dir}')
+    print(f'{args.users} users, {args.playlists_per_user} playlists per user, {args.tracks_per_playlist} tracks per playlist\n')
+
+    results = []
+
+    try:
+        for stage in args.stages:
+            requests_before = dict(server.request_counts)
+
+            if stage != 'cf_extract' and args.backfill_days > 1:
+                copy_landing_to_previous_days(data_dir, args.backfill_days)
+
+            # The shards of cf_extract run at the same time, like the parallel for of the workflow
+            shard_indices = range(args.shards) if stage == 'cf_extract' else [0]
+            processes = []
+
+            for shard_index in shard_indices:
+                result_file = os.path.join(data_dir, f'{stage}.part-{shard_index:04d}.result.json')
+                log_file = os.path.join(data_dir, f'{stage}.part-{shard_index:04d}.log')
+
+                command = [
+                    sys.executable, os.path.abspath(__file__),
+                    '--stage', stage,
+                    '--shards', str(args.shards),
+                    '--shard-index', str(shard_index),
+                    '--data-dir', data_dir,
+                    '--result-file', result_file,
+                    '--spotify-url', server.base_url,
+                    '--token-url', server.token_url,
+                    '--max-workers', str(args.max_workers),
+                    '--extract-time-budget', str(args.extract_time_budget),
+                    '--checkpoint-interval', str(args.checkpoint_interval),
+                    '--fact-memory-ceiling-mb', str(args.fact_memory_ceiling_mb),
+                    '--backfill-days', str(args.backfill_days),
+                ]
+
+                log = open(log_file, 'w')
+                processes.append((subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT), log, log_file, result_file))
+
+            shard_results = []
+
+            for process, log, log_file, result_file in processes:
+                process.wait()
+                log.close()
+
+                if process.returncode != 0:
+                    with open(log_file) as log:
+                        print(log.read())
+
+                    raise Exception(f'The stage {stage} failed, the log is in {log_file}')
+
+                with open(result_file) as file:
+                    shard_results.append(json.load(file))
+
+            # The stage lasts as long as its slowest shard
+            wall_seconds = max(shard_result['wall_seconds'] for shard_result in shard_results)
+            records = sum(shard_result['records'] for shard_result in shard_results)
+
+            result = {
+                'stage': stage,
+                'wall_seconds': wall_seconds,
+                'invocations': sum(shard_result['invocations'] for shard_result in shard_results),
+                'import_seconds': max(shard_result['import_seconds'] for shard_result in shard_results),
+                'peak_rss_mb': max(shard_result['peak_rss_mb'] for shard_result in shard_results),
+                'records': records,
+                'records_per_second': records / wall_seconds if wall_seconds else 0,
+                'shards': shard_results,
+            }
+
+            result['spotify_requests'] = {
+                endpoint: count - requests_before.get(endpoint, 0)
+                for endpoint, count in server.request_counts.items()
+                if count != requests_before.get(endpoint, 0)
+            }
+            results.append(result)
+
+            print(
+                f"{stage:<32} {result['wall_seconds']:>8.2f}s wall {result['import_seconds']:>6.2f}s import "
+                f"{result['peak_rss_mb']:>8.1f} MB peak {result['records']:>10} records {result['records_per_second']:>10.0f} records/s"
+            )
+
+    finally:
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'parameters': vars(args), 'results': results}, file, indent=2)
+
+        print(f'\nResults written to {args.output}')
+
+    return results
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the songs ETL')
+
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--playlists-per-user', type=int, default=5)
+    parser.add_argument('--tracks-per-playlist', type=int, default=100)
+    parser.add_argument('--latency-ms', type=float, default=0, help='Latency added to each Spotify API call')
+    parser.add_argument('--max-workers', type=int, default=8, help='SPOTIFY_MAX_WORKERS of cf_extract')
+    parser.add_argument('--extract-time-budget', type=float, default=340, help='EXTRACT_TIME_BUDGET_SECONDS of cf_extract')
+    parser.add_argument('--checkpoint-interval', type=float, default=30, help='CHECKPOINT_INTERVAL_SECONDS of cf_extract')
+    parser.add_argument('--fact-memory-ceiling-mb', type=int, default=0, help='FACT_MEMORY_CEILING_MB of cf_transform, 0 builds the fact in one chunk')
+    parser.add_argument('--backfill-days', type=int, default=1, help='Days read by the stages after cf_extract, the data landed today is copied to the previous days')
+    parser.add_argument('--shards', type=int, default=1, help='Shards of cf_extract, each one runs in its own process')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=WORKFLOW_STAGES)
+    parser.add_argument('--data-dir', help='Where the fake buckets and tables are kept, a temporary directory by default')
+    parser.add_argument('--output', help='JSON file for the results')
+
+    # Used by the runner to start each stage
+    parser.add_argument('--stage', choices=list(STAGES), help=argparse.SUPPRESS)
+    parser.add_argument('--shard-index', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    parser.add_argument('--spotify-url', help=argparse.SUPPRESS)
+    parser.add_argument('--token-url', help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = get_arguments()
+
+    if arguments.stage:
+        run_stage(arguments)
+    else:
+        run_benchmark(arguments)
@@ -0,0 +1,34 @@
+import functions_framework
+from dotenv import load_dotenv
+import os
+from songs_common.dimensions import DIMENSIONS, build_dimensions
+from songs_common.landing import get_landing_range
+from songs_common.telemetry import stage
+
+load_dotenv(override=True)
+
+PROJECT_ID = os.getenv('PROJECT_ID')
+if not PROJECT_ID:
+    raise ValueError("PROJECT_ID environment variable not set.")
+
+DATASET_ID = os.getenv('DATASET_ID')
+if not DATASET_ID:
+    raise ValueError("DATASET_ID environment variable not set.")
+
+@functions_framework.http
+@stage('main')
+def main(request):
+    """
+    Builds every dimension in one pass over the landing data of the day, or of the days of
+    a backfill: the tracks are read once for the artists and the tracks, and the tables are
+    loaded at the same time.
+    """
+    print('Create dimensions...')
+
+    members = build_dimensions(
+        {name: f'{DATASET_ID}.{name}' for name in DIMENSIONS},
+        f'landing-{PROJECT_ID}',
+        *get_landing_range(request),
+    )
+
+    return {'status': 'complete', 'members': members}
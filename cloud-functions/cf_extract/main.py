@@ -1,12 +1,21 @@
 import functions_framework
 from dotenv import load_dotenv
-from requests import post, get
+from concurrent.futures import ThreadPoolExecutor
 import os
-import json
-from google.cloud import bigquery
-from google.cloud import secretmanager
-from typing import Dict, Iterator
+import time
+import hashlib
+import pyarrow as pa
+import pyarrow.compute as pc
 from datetime import date
+from spotify_client import SpotifyClient
+from response_cache import ResponseCache
+from schemas import normalize, PLAYLIST_RECORD, PLAYLIST_TRACK_RECORD, PLAYLIST_TRACKS_FIELDS, ARTIST_RECORD, ALBUM_RECORD
+from songs_common.gcp import get_bucket, get_secret_manager_client
+from songs_common.codec import dumps, loads
+from songs_common.records import PlaylistTracks, Track, Artist, Album, TracksEncoder, get_shared_album, iterate_playlists_tracks
+from songs_common.telemetry import stage, timed_call
+from songs_common.landing import NdjsonBlobWriter, ParquetBlobWriter, get_part_path, iterate_ndjson_from_bucket, read_parquet_from_bucket
+from songs_common.warehouse import read_bigquery_table
 
 load_dotenv(override=True)
 
@@ -18,10 +27,48 @@ SONGS_SECRET_NAME = os.getenv('SONGS_SECRET_NAME')
 if not SONGS_SECRET_NAME:
     raise ValueError('SONGS_SECRET_NAME environment variable is not set')
 
-SPOTIFY_CLIENT_ID = None
-SPOTIFY_CLIENT_SECRET = None
-SPOTIFY_ACCESS_TOKEN = None
-SPOTIFY_BASE_URL = 'https://api.spotify.com/v1'
+# The users whose playlists are extracted
+DATASET_ID = os.getenv('DATASET_ID')
+if not DATASET_ID:
+    raise ValueError('DATASET_ID environment variable is not set')
+
+TABLE_ID = os.getenv('TABLE_ID')
+if not TABLE_ID:
+    raise ValueError('TABLE_ID environment variable is not set')
+
+LANDING_GZIP = os.getenv('LANDING_GZIP', 'true').lower() == 'true'
+
+# snapshot_id of every playlist in the last extraction of each shard, used to skip the playlists that didn't change
+SNAPSHOT_MANIFESTS_PREFIX = 'spotify/manifests/snapshots/'
+
+# Most ids the Spotify endpoints of several artists and albums take in one call
+ARTISTS_BATCH_SIZE = 50
+ALBUMS_BATCH_SIZE = 20
+
+SPOTIFY_MAX_WORKERS = int(os.getenv('SPOTIFY_MAX_WORKERS', '8'))
+SPOTIFY_MAX_RETRIES = int(os.getenv('SPOTIFY_MAX_RETRIES', '5'))
+
+# The extraction stops taking new work after EXTRACT_TIME_BUDGET_SECONDS, which must leave time before
+# the function timeout to save the checkpoint. The progress is saved every CHECKPOINT_INTERVAL_SECONDS.
+EXTRACT_TIME_BUDGET_SECONDS = float(os.getenv('EXTRACT_TIME_BUDGET_SECONDS', '340'))
+CHECKPOINT_INTERVAL_SECONDS = float(os.getenv('CHECKPOINT_INTERVAL_SECONDS', '30'))
+CHECKPOINTS_PREFIX = 'spotify/checkpoints/'
+
+# Set at the start of each invocation
+EXTRACTION_DEADLINE = None
+SHARD = {'index': 0, 'count': 1, 'spotify_ids': None}
+
+# Responses kept with their ETags between the runs, in GCS because /tmp doesn't survive a cold start.
+# The bodies are compressed in memory, SPOTIFY_CACHE_MAX_MB=0 disables the cache.
+SPOTIFY_CACHE_PREFIX = 'spotify/cache/'
+SPOTIFY_CACHE_MAX_MB = int(os.getenv('SPOTIFY_CACHE_MAX_MB', '32'))
+SPOTIFY_CACHE_TTL_HOURS = float(os.getenv('SPOTIFY_CACHE_TTL_HOURS', '168'))
+
+# Kept between invocations, so warm instances reuse the connections, the secret, the token and the cache
+SPOTIFY_CLIENT = None
+
+# Shard whose responses are in the cache of SPOTIFY_CLIENT, a warm instance can be invoked for another shard
+SPOTIFY_CACHE_SHARD = None
 
 
 ###################################################################################
@@ -29,14 +76,12 @@ SPOTIFY_BASE_URL = 'https://api.spotify.com/v1'
 ###################################################################################
 
 def upload_object_to_bucket(bucket_name, source_file, destination_blob_name):
-    from google.cloud import storage
-
     try:
-        client = storage.Client() # There is no need to use from_service_account_json because in the CF it can authenticate normally.
-        bucket = client.get_bucket(bucket_name)
+        bucket = get_bucket(bucket_name)
 
         blob = bucket.blob(destination_blob_name)
-        blob.upload_from_filename(source_file)
+        with timed_call('gcs', bytes_uploaded=os.path.getsize(source_file)):
+            blob.upload_from_filename(source_file)
 
         print(f'File {source_file} uploaded to {bucket_name}/{destination_blob_name}')
     
@@ -44,268 +89,693 @@ def upload_object_to_bucket(bucket_name, source_file, destination_blob_name):
         raise Exception(f'Error uploading object to {bucket_name}: {str(e)}')
 
 def upload_json_to_bucket(bucket_name, json_data, destination_blob_name):
-    from google.cloud import storage
-
     if destination_blob_name[0] == '/':
         destination_blob_name = destination_blob_name[1:]
 
     try:
-        client = storage.Client()
-        bucket = client.get_bucket(bucket_name)
+        bucket = get_bucket(bucket_name)
+
+        data = dumps(json_data)
 
         blob = bucket.blob(destination_blob_name)
-        blob.upload_from_string(json.dumps(json_data))
+        with timed_call('gcs', bytes_uploaded=len(data)):
+            blob.upload_from_string(data, content_type='application/json')
 
         print(f'JSON data uploaded to {bucket_name}/{destination_blob_name}')
     
     except Exception as e:
         raise Exception(f'Error uploading json to {bucket_name}: {str(e)}')
-    
-def iterate_object_from_bucket(bucket_name, object_path) -> Iterator[Dict]:
-    from google.cloud import storage
-    
-    try:
-        client = storage.Client()
-
-        bucket = client.get_bucket(bucket_name)
-        blobs = bucket.list_blobs(prefix=object_path)
-
-        for blob in blobs:
-            blob_json = blob.download_as_text()
-            blob_dict = json.loads(blob_json)
 
-            yield blob_dict
+def retrieve_object_from_bucket(bucket_name, object_path, default=None):
+    from google.api_core.exceptions import NotFound
 
-        print(f"Data from '{object_path}' retrieved.")
-
-    except Exception as e:
-        raise Exception(f"Error while getting blobs from bucket: {e}")
-    
-def retrieve_object_from_bucket(bucket_name, object_path):
-    from google.cloud import storage
-    
     try:
-        client = storage.Client()
-
-        bucket = client.get_bucket(bucket_name)
+        bucket = get_bucket(bucket_name)
         blob = bucket.blob(object_path)
-        json_data = blob.download_as_text()
+        with timed_call('gcs'):
+            json_data = blob.download_as_bytes()
 
         print(f"Object '{object_path}' retrieved.")
 
-        return json.loads(json_data)
+        return loads(json_data)
+
+    except NotFound:
+        return default
 
     except Exception as e:
         raise Exception(f"Error while getting objects from bucket: {e}")
-    
-def get_users_from_bigquery():
-    client = bigquery.Client()
-    query_job = client.query(f"""
-        SELECT *
-        FROM prep_songs_dimensions.dim_user
-    """)
 
-    rows = query_job.result()
+class LandingDatasetWriter:
+    """
+    Writes the part of the shard of a landing dataset of the day as NDJSON, with the records
+    as they come from Spotify or as the lines of `encode`, and as a flattened Parquet copy for
+    the readers that only need some columns.
+    """
 
-    return rows
+    def __init__(self, dataset, schema, flatten, encode=None):
+        self.writers = [
+            NdjsonBlobWriter(f'landing-{PROJECT_ID}', get_part_path(dataset, date.today(), SHARD['index'], 'ndjson'), compress=LANDING_GZIP, encode=encode),
+            ParquetBlobWriter(f'landing-{PROJECT_ID}', get_part_path(dataset, date.today(), SHARD['index'], 'parquet'), schema, flatten),
+        ]
 
-def get_secret_manager_secret():
-    global SPOTIFY_CLIENT_ID
-    global SPOTIFY_CLIENT_SECRET
+    def __enter__(self):
+        for writer in self.writers:
+            writer.__enter__()
+
+        return self
+
+    def write(self, record):
+        for writer in self.writers:
+            writer.write(record)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for writer in self.writers:
+            writer.__exit__(exc_type, exc_value, traceback)
 
+        return False
+
+def delete_blobs_from_bucket(bucket_name, prefix):
+    with timed_call('gcs'):
+        for blob in get_bucket(bucket_name).list_blobs(prefix=prefix):
+            blob.delete()
+
+def get_users_from_bigquery():
+    users = read_bigquery_table(f'{DATASET_ID}.{TABLE_ID}', ['dim_user_id', 'name', 'spotify_id'])
+
+    return users.to_pylist()
+
+def get_secret_manager_secret():
     print('Getting secret manager secret')
     
-    secretManagerClient = secretmanager.SecretManagerServiceClient()
-
     request = { "name": f"projects/{PROJECT_ID}/secrets/{SONGS_SECRET_NAME}/versions/latest" }
-    response = secretManagerClient.access_secret_version(request)
-
-    credentials = json.loads(response.payload.data.decode('UTF-8'))
+    response = get_secret_manager_client().access_secret_version(request)
 
-    SPOTIFY_CLIENT_ID = credentials.get('spotify_client_id')
-    SPOTIFY_CLIENT_SECRET = credentials.get('spotify_client_secret')
+    return loads(response.payload.data)
 
 ###################################################################################
 # Functions to interact with the Spotify API
 ###################################################################################
 
-def get_access_token():
-    global SPOTIFY_ACCESS_TOKEN
+def get_spotify_client() -> SpotifyClient:
+    global SPOTIFY_CLIENT
 
-    url = 'https://accounts.spotify.com/api/token'
+    if SPOTIFY_CLIENT is None:
+        SPOTIFY_CLIENT = SpotifyClient(
+            get_credentials=get_secret_manager_secret,
+            pool_size=SPOTIFY_MAX_WORKERS,
+            max_retries=SPOTIFY_MAX_RETRIES,
+            cache=load_spotify_response_cache(),
+        )
 
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
+    return SPOTIFY_CLIENT
 
-    data = {
-        'grant_type': 'client_credentials',
-        'client_id': SPOTIFY_CLIENT_ID,
-        'client_secret': SPOTIFY_CLIENT_SECRET,
-    }
+def get_spotify_cache_path():
+    # One cache per shard, the shards run at the same time and would overwrite each other
+    return f'{SPOTIFY_CACHE_PREFIX}responses-part-{SHARD["index"]:04d}.ndjson'
 
-    response = post(url, headers=headers, data=data)
-    response.raise_for_status()
-    SPOTIFY_ACCESS_TOKEN = response.json()['access_token']
+def load_spotify_response_cache():
+    global SPOTIFY_CACHE_SHARD
+    SPOTIFY_CACHE_SHARD = SHARD['index']
 
-def get_an_artist_by_id(artist_id):
-    url = f'{SPOTIFY_BASE_URL}/artists/{artist_id}'
+    if SPOTIFY_CACHE_MAX_MB <= 0:
+        return None
 
-    headers = {
-        'Authorization': f'Bearer {SPOTIFY_ACCESS_TOKEN}'
-    }
+    cache = ResponseCache(max_bytes=SPOTIFY_CACHE_MAX_MB * 1024 * 1024, ttl_seconds=SPOTIFY_CACHE_TTL_HOURS * 3600)
+
+    try:
+        cache.load(iterate_ndjson_from_bucket(f'landing-{PROJECT_ID}', get_spotify_cache_path()))
+    except FileNotFoundError:
+        pass # The first run of the shard
+
+    print(f'{len(cache)} Spotify responses in the cache')
+    return cache
+
+def use_shard_spotify_response_cache():
+    client = get_spotify_client()
+
+    if SPOTIFY_CACHE_SHARD != SHARD['index']:
+        client.cache = load_spotify_response_cache()
+
+def save_spotify_response_cache():
+    cache = get_spotify_client().cache
+
+    if cache is None:
+        return
+
+    print(f'{cache.hits} Spotify responses reused from the cache')
 
-    response = get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    with NdjsonBlobWriter(f'landing-{PROJECT_ID}', get_spotify_cache_path(), compress=True) as writer:
+        for entry in cache.dump():
+            writer.write(entry)
+
+def get_an_artist_by_id(artist_id):
+    return get_spotify_client().get(f'/artists/{artist_id}')
 
 def get_all_albums_by_artist_id(artist_id):
-    artist = get_an_artist_by_id(artist_id)
+    print(f'Getting albums from artist: {artist_id}')
 
-    url = f'{SPOTIFY_BASE_URL}/artists/{artist_id}/albums?include_groups=album'
+    return get_spotify_client().get(f'/artists/{artist_id}/albums?include_groups=album')
 
-    headers = {
-        'Authorization': f'Bearer {SPOTIFY_ACCESS_TOKEN}'
-    }
+def get_several_artists(artist_ids):
+    return get_spotify_client().get(f'/artists?ids={",".join(artist_ids)}')['artists']
 
-    response = get(url, headers=headers)
-    response.raise_for_status()
+def get_several_albums(album_ids):
+    return get_spotify_client().get(f'/albums?ids={",".join(album_ids)}')['albums']
 
-    print(f'Getting albums from artist: {artist["name"]}')
+def get_all_in_batches(get_batch, ids, batch_size):
+    batches = [ids[start:start + batch_size] for start in range(0, len(ids), batch_size)]
 
-    return response.json()
+    with ThreadPoolExecutor(max_workers=SPOTIFY_MAX_WORKERS) as executor:
+        for items in executor.map(get_batch, batches):
+            # Spotify answers null for the ids it doesn't find
+            yield from (item for item in items if item is not None)
 
-def get_playlists_by_user_id(user_id):
-    url = f'{SPOTIFY_BASE_URL}/users/{user_id}/playlists'
+def get_playlists_by_user_id(user_id, limit=50, offset=0):
+    return get_spotify_client().get(f'/users/{user_id}/playlists?limit={limit}&offset={offset}')
 
-    headers = {
-        'Authorization': f'Bearer {SPOTIFY_ACCESS_TOKEN}'
-    }
+def get_all_pages(get_page, limit):
+    first_page = get_page(limit=limit, offset=0)
+
+    # The first page tells how many items there are, so the other pages can be requested at once
+    offsets = range(limit, first_page['total'], limit)
 
-    response = get(url, headers=headers)
-    response.raise_for_status()
+    with ThreadPoolExecutor(max_workers=SPOTIFY_MAX_WORKERS) as executor:
+        pages = list(executor.map(lambda offset: get_page(limit=limit, offset=offset), offsets))
 
-    return response.json()
+    items = list(first_page['items'])
+
+    for page in pages:
+        items.extend(page['items'])
+
+    return items
+
+def get_all_playlists_by_user_id(user_id):
+    return get_all_pages(
+        lambda limit, offset: get_playlists_by_user_id(user_id, limit=limit, offset=offset),
+        limit=50,
+    )
 
 def get_tracks_by_playlist_id(playlist_id, limit=100, offset=0, fields=''):
-    url = f'{SPOTIFY_BASE_URL}/playlists/{playlist_id}/tracks?limit={limit}&offset={offset}&fields={fields}'
+    return get_spotify_client().get(f'/playlists/{playlist_id}/tracks?limit={limit}&offset={offset}&fields={fields}')
 
-    headers = {
-        'Authorization': f'Bearer {SPOTIFY_ACCESS_TOKEN}'
-    }
 
-    response = get(url, headers=headers)
-    response.raise_for_status()
+###################################################################################
+# Flattened landing schemas
+###################################################################################
+
+PLAYLISTS_PARQUET_SCHEMA = pa.schema([
+    ('spotify_id', pa.string()),
+    ('dim_user_id', pa.string()),
+    ('playlist_id', pa.string()),
+    ('name', pa.string()),
+    ('snapshot_id', pa.string()),
+    ('owner_id', pa.string()),
+    ('collaborative', pa.bool_()),
+    ('public', pa.bool_()),
+    ('tracks_total', pa.int64()),
+])
+
+TRACKS_PARQUET_SCHEMA = pa.schema([
+    ('playlist_id', pa.string()),
+    ('added_at', pa.timestamp('s', tz='UTC')),
+    ('is_local', pa.bool_()),
+    ('track_id', pa.string()),
+    ('track_name', pa.string()),
+    ('duration_ms', pa.int64()),
+    ('explicit', pa.bool_()),
+    ('album_id', pa.string()),
+    ('album_name', pa.string()),
+    ('album_release_date', pa.string()), # The precision goes from year to day, so it stays a string
+    ('artist_ids', pa.list_(pa.string())),
+    ('artist_names', pa.list_(pa.string())),
+])
+
+ARTISTS_PARQUET_SCHEMA = pa.schema([
+    ('artist_id', pa.string()),
+    ('name', pa.string()),
+    ('genres', pa.list_(pa.string())),
+    ('popularity', pa.int64()),
+    ('followers_total', pa.int64()),
+    ('image_url', pa.string()),
+])
+
+ALBUMS_PARQUET_SCHEMA = pa.schema([
+    ('album_id', pa.string()),
+    ('name', pa.string()),
+    ('album_type', pa.string()),
+    ('release_date', pa.string()),
+    ('release_date_precision', pa.string()),
+    ('total_tracks', pa.int64()),
+    ('label', pa.string()),
+    ('popularity', pa.int64()),
+    ('artist_ids', pa.list_(pa.string())),
+    ('image_url', pa.string()),
+])
+
+def flatten_user_playlists(user_playlists):
+    for playlist in user_playlists['playlists']:
+        yield {
+            'spotify_id': user_playlists['spotify_id'],
+            'dim_user_id': user_playlists.get('dim_user_id'),
+            'playlist_id': playlist['id'],
+            'name': playlist.get('name'),
+            'snapshot_id': playlist.get('snapshot_id'),
+            'owner_id': (playlist.get('owner') or {}).get('id'),
+            'collaborative': playlist.get('collaborative'),
+            'public': playlist.get('public'),
+            'tracks_total': (playlist.get('tracks') or {}).get('total'),
+        }
+
+def flatten_playlist_tracks(playlist_tracks: PlaylistTracks):
+    for track in playlist_tracks.tracks:
+        album = track.album
+
+        yield {
+            'playlist_id': playlist_tracks.playlist_id,
+            'added_at': track.added_at,
+            'is_local': track.is_local,
+            'track_id': track.id,
+            'track_name': track.name,
+            'duration_ms': track.duration_ms,
+            'explicit': track.explicit,
+            'album_id': album.id if album else None,
+            'album_name': album.name if album else None,
+            'album_release_date': album.release_date if album else None,
+            'artist_ids': [artist.id for artist in track.artists],
+            'artist_names': [artist.name for artist in track.artists],
+        }
 
-    return response.json()
+def get_first_image_url(item):
+    return item.images[0].url if item.images else None
+
+def flatten_artist(artist: Artist):
+    yield {
+        'artist_id': artist.id,
+        'name': artist.name,
+        'genres': artist.genres,
+        'popularity': artist.popularity,
+        'followers_total': artist.followers_total,
+        'image_url': get_first_image_url(artist),
+    }
+
+def flatten_album(album: Album):
+    yield {
+        'album_id': album.id,
+        'name': album.name,
+        'album_type': album.album_type,
+        'release_date': album.release_date,
+        'release_date_precision': album.release_date_precision,
+        'total_tracks': album.total_tracks,
+        'label': album.label,
+        'popularity': album.popularity,
+        'artist_ids': [artist.id for artist in album.artists],
+        'image_url': get_first_image_url(album),
+    }
 
 
 ###################################################################################
 # Steps of the extraction
 ###################################################################################
 
+def extract_user_playlists(user):
+    print(f'Getting playlists from user: {user["name"]}')
+    playlists = get_all_playlists_by_user_id(user['spotify_id'])
+
+    return {
+        'spotify_id': user['spotify_id'],
+        'dim_user_id': user['dim_user_id'], # Kept so the fact doesn't have to read dim_user again
+        'playlists': [normalize(PLAYLIST_RECORD, playlist) for playlist in playlists]
+    }
+
+def get_shard(request):
+    """
+    Reads the shard of the invocation from the request body, e.g. {"shard": {"index": 3, "count": 8}}.
+    The users of the shard are the ones whose spotify_id hashes to `index`, or the ones in
+    `spotify_ids` when the list is given. Without a shard, the invocation extracts every user.
+    """
+    payload = request.get_json(silent=True) if request is not None else None
+    shard = (payload or {}).get('shard') or {}
+
+    return {
+        'index': int(shard.get('index', 0)),
+        'count': int(shard.get('count', 1)),
+        'spotify_ids': shard.get('spotify_ids'),
+    }
+
+def is_user_in_shard(spotify_id):
+    if SHARD['spotify_ids'] is not None:
+        return spotify_id in SHARD['spotify_ids']
+
+    # hash() changes between processes, the shard of a user has to be the same in every instance and run
+    user_hash = int.from_bytes(hashlib.blake2b(spotify_id.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    return user_hash % SHARD['count'] == SHARD['index']
+
+@stage('extract_spotify_playlists')
 def extract_spotify_playlists():
     print('Extract Spotify playlists')
 
-    print('Getting users from BigQuery')
-    users = get_users_from_bigquery()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # The secret and the token are fetched while the users are read
+        access_token = executor.submit(get_spotify_client().get_access_token)
 
-    all_playlists = []
+        print('Getting users from BigQuery')
+        users = [user for user in get_users_from_bigquery() if is_user_in_shard(user['spotify_id'])]
 
-    for user in users:
-        print(f'Getting playlists from user: {user["name"]}')
-        # TODO: paralelizar
-        playlists = get_playlists_by_user_id(user['spotify_id'])
-
-        playlists_dict = {
-            'spotify_id': user['spotify_id'],
-            'playlists': playlists['items']
-        }
+        access_token.result()
 
-        all_playlists.append(playlists_dict)
+    print(f'{len(users)} users in the shard {SHARD["index"]} of {SHARD["count"]}')
 
     print('Uploading playlists to the bucket')
-    upload_json_to_bucket(
-        bucket_name=f'landing-{PROJECT_ID}',
-        json_data=all_playlists,
-        destination_blob_name=f'spotify/playlists/{date.today()}.json',
-    )
+    with LandingDatasetWriter('playlists', PLAYLISTS_PARQUET_SCHEMA, flatten_user_playlists) as writer:
+        with ThreadPoolExecutor(max_workers=SPOTIFY_MAX_WORKERS) as executor:
+            for user_playlists in executor.map(extract_user_playlists, users):
+                writer.write(user_playlists)
+
+def extract_playlist_tracks(playlist, offset=0, albums=None) -> PlaylistTracks:
+    """
+    Gets the tracks of `playlist` from `offset` on. When the time budget runs out before
+    the last page, the tracks got so far are returned with the `next_offset` to resume from.
+    The tracks of an album share the AlbumReference kept in `albums`.
+    """
+    LIMIT = 100
 
-def extract_spotify_tracks():
-    print('Extract Spotify tracks')
+    all_tracks = []
 
-    LIMIT = 100
+    while True:
+        if is_past_deadline():
+            return PlaylistTracks(playlist['id'], all_tracks, next_offset=offset)
+
+        # Spotify only sends the fields of PLAYLIST_TRACK_RECORD
+        tracks = get_tracks_by_playlist_id(playlist['id'], limit=LIMIT, offset=offset, fields=PLAYLIST_TRACKS_FIELDS)
+        print(f'Got {len(tracks["items"])} tracks from the playlist {playlist["id"]}')
+
+        for item in tracks['items']:
+            track = normalize(PLAYLIST_TRACK_RECORD, item, Track)
+            if track.album is not None:
+                track.album = get_shared_album(track.album, albums)
+
+            all_tracks.append(track)
+
+        if tracks['next'] == None:
+            break
+
+        offset += LIMIT
+
+    return PlaylistTracks(playlist['id'], all_tracks)
+
+def get_snapshot_manifest_path():
+    # A playlist is only found in the manifest of its shard while the number of shards stays the same
+    return f'{SNAPSHOT_MANIFESTS_PREFIX}part-{SHARD["index"]:04d}.json'
+
+def reuse_unchanged_playlists_tracks(playlists, writer, albums=None):
+    """
+    Copies to `writer` the tracks of the playlists whose snapshot_id is the same as in the
+    last extraction, reading them from the tracks file of that extraction.
+    Returns the ids of the playlists that were copied.
+    """
+    manifest = retrieve_object_from_bucket(f'landing-{PROJECT_ID}', get_snapshot_manifest_path(), default={})
+
+    previous_snapshots = manifest.get('playlists', {})
+    previous_tracks_path = manifest.get('tracks_path')
+
+    unchanged_playlist_ids = {
+        playlist['id']
+        for playlist in playlists
+        if playlist.get('snapshot_id') and previous_snapshots.get(playlist['id']) == playlist['snapshot_id']
+    }
+
+    if not unchanged_playlist_ids or not previous_tracks_path:
+        return set()
+
+    print(f'Reusing the tracks of {len(unchanged_playlist_ids)} unchanged playlists from {previous_tracks_path}')
+
+    reused_playlist_ids = set()
+
+    try:
+        for playlist_tracks in iterate_playlists_tracks(iterate_ndjson_from_bucket(f'landing-{PROJECT_ID}', previous_tracks_path), albums):
+            playlist_id = playlist_tracks.playlist_id
+
+            if playlist_id in unchanged_playlist_ids and playlist_id not in reused_playlist_ids:
+                writer.write(playlist_tracks)
+                reused_playlist_ids.add(playlist_id)
+
+    # Only raised before the first record, when the tracks file of the last extraction is gone
+    except FileNotFoundError:
+        print(f'{previous_tracks_path} does not exist anymore, the tracks are extracted again')
+
+    return reused_playlist_ids
+
+class TracksCheckpoint:
+    """
+    Progress of the tracks extraction of the day, saved in the landing bucket.
+
+    The tracks are written to NDJSON parts and, every CHECKPOINT_INTERVAL_SECONDS, the part
+    is finalized and the state is saved with the playlists it completes and the offsets
+    of the unfinished ones. A run that is stopped only loses what came after the last save.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self._writer = None
+        self._playlists_done = []
+        self._playlists_offsets = {}
+        self._saved_at = time.monotonic()
+
+    @property
+    def playlists_done(self):
+        return set(self.state['playlists_done']) | set(self._playlists_done)
+
+    def get_offset(self, playlist_id):
+        return self.state['playlists_offsets'].get(playlist_id, 0)
+
+    def write(self, playlist_tracks: PlaylistTracks):
+        if self._writer is None:
+            part_path = get_checkpoint_path(f'tracks-part-{len(self.state["parts"]):04d}.ndjson')
+
+            self._writer = NdjsonBlobWriter(f'landing-{PROJECT_ID}', part_path, compress=LANDING_GZIP, encode=TracksEncoder())
+            self._writer.__enter__()
+
+        self._writer.write(playlist_tracks)
+
+        if playlist_tracks.next_offset is None:
+            self._playlists_done.append(playlist_tracks.playlist_id)
+        else:
+            self._playlists_offsets[playlist_tracks.playlist_id] = playlist_tracks.next_offset
+
+    def save_if_due(self):
+        if time.monotonic() - self._saved_at >= CHECKPOINT_INTERVAL_SECONDS:
+            self.save()
+
+    def save(self):
+        # The part is finalized before the state points to it
+        if self._writer is not None:
+            self._writer.__exit__(None, None, None)
+            self.state['parts'].append(self._writer.destination_blob_name)
+            self._writer = None
+
+        self.state['playlists_done'].extend(self._playlists_done)
+        self.state['playlists_offsets'].update(self._playlists_offsets)
+        for playlist_id in self._playlists_done:
+            self.state['playlists_offsets'].pop(playlist_id, None)
+
+        self._playlists_done = []
+        self._playlists_offsets = {}
+
+        save_checkpoint_state(self.state)
+        self._saved_at = time.monotonic()
+
+def is_past_deadline():
+    return EXTRACTION_DEADLINE is not None and time.monotonic() >= EXTRACTION_DEADLINE
+
+def get_checkpoint_path(name):
+    return f'{get_checkpoint_prefix()}{name}'
+
+def get_checkpoint_prefix():
+    return f'{CHECKPOINTS_PREFIX}{date.today()}/part-{SHARD["index"]:04d}/'
+
+def load_checkpoint_state():
+    state = retrieve_object_from_bucket(f'landing-{PROJECT_ID}', get_checkpoint_path('state.json'))
+
+    if state is not None:
+        print(f'Resuming the extraction from the checkpoint, steps done: {state["steps_done"]}')
+        return state
+
+    return {
+        'steps_done': [],
+        'tracks_reused': False,
+        'playlists_done': [],
+        'playlists_offsets': {},
+        'parts': [],
+    }
+
+def save_checkpoint_state(state):
+    upload_json_to_bucket(f'landing-{PROJECT_ID}', state, get_checkpoint_path('state.json'))
+
+def write_tracks_from_checkpoint(state):
+    """
+    Writes the tracks dataset of the day from the checkpoint parts, joining the tracks of
+    the playlists that were extracted over several runs.
+    """
+    unfinished_playlists_tracks = {}
+    albums = {}
+
+    with LandingDatasetWriter('tracks', TRACKS_PARQUET_SCHEMA, flatten_playlist_tracks, encode=TracksEncoder()) as writer:
+        for part_path in state['parts']:
+            for playlist_tracks in iterate_playlists_tracks(iterate_ndjson_from_bucket(f'landing-{PROJECT_ID}', part_path), albums):
+                playlist_id = playlist_tracks.playlist_id
+                tracks = unfinished_playlists_tracks.pop(playlist_id, []) + playlist_tracks.tracks
+
+                if playlist_tracks.next_offset is not None:
+                    unfinished_playlists_tracks[playlist_id] = tracks
+                    continue
+
+                writer.write(PlaylistTracks(playlist_id, tracks))
+
+@stage('extract_spotify_tracks')
+def extract_spotify_tracks(state):
+    """
+    Extracts the tracks of the playlists that are not in the checkpoint yet.
+    Returns False when the time budget ran out before all of them were done.
+    """
+    print('Extract Spotify tracks')
 
     print('Getting users playlists from the bucket')    
-    users_playlists = retrieve_object_from_bucket(f'landing-{PROJECT_ID}', f'spotify/playlists/{date.today()}.json')
-
-    all_playlists = []
-
-    for user_playlists in users_playlists:
-        for playlist in user_playlists['playlists']:
-            all_tracks = []
-            offset = 0
-
-            while True:
-                tracks = get_tracks_by_playlist_id(playlist['id'], limit=LIMIT, offset=offset)
-                print(f'Got {len(tracks["items"])} tracks from the playlist {playlist["id"]}')
-
-                # all_tracks.extend(tracks['items'])
-
-                for track in tracks['items']:
-                    # print(track['track']['name'], track['track']['album']['total_tracks'])
-
-                    all_tracks.append({
-                        'added_at': track['added_at'],
-                        'is_local': track['is_local'],
-                        'id': track['track']['id'],
-                        'name': track['track']['name'],
-                        'duration_ms': track['track']['duration_ms'],
-                        'explicit': track['track']['explicit'],
-                        'album': {
-                            'id': track['track']['album']['id'],
-                            'name': track['track']['album']['name'],
-                            'release_date': track['track']['album']['release_date'],
-                            'total_tracks': track['track']['album'].get('total_tracks', 9999), # TODO: check it
-                            'images': track['track']['album']['images'],
-                        },
-                        'artists': [
-                            {
-                                'id': artist['id'],
-                                'name': artist['name']
-                            }
-                            for artist in track['track']['artists']
-                        ]
-                    })
-                
-                if tracks['next'] == None:
-                    break
-                
-                offset += LIMIT
-            
-            tracks = {
-                'playlist_id': playlist['id'],
-                'tracks': all_tracks
-            }
-
-            all_playlists.append(tracks)
-    
-    print('Uploading tracks to the bucket')
+    users_playlists = iterate_ndjson_from_bucket(f'landing-{PROJECT_ID}', get_part_path('playlists', date.today(), SHARD['index'], 'ndjson'))
+
+    # A playlist followed by several users is extracted once, the checkpoint counts it once
+    playlists = list({
+        playlist['id']: playlist
+        for user_playlists in users_playlists
+        for playlist in user_playlists['playlists']
+    }.values())
+
+    checkpoint = TracksCheckpoint(state)
+
+    # One AlbumReference per album for all the tracks extracted by this invocation
+    albums = {}
+
+    if not state['tracks_reused']:
+        reuse_unchanged_playlists_tracks(playlists, checkpoint, albums)
+        state['tracks_reused'] = True
+
+    playlists_done = checkpoint.playlists_done
+    pending_playlists = [playlist for playlist in playlists if playlist['id'] not in playlists_done]
+
+    print(f'Getting tracks from {len(pending_playlists)} playlists with {SPOTIFY_MAX_WORKERS} workers')
+
+    # Each playlist is written as soon as it is extracted, map keeps the playlists order
+    with ThreadPoolExecutor(max_workers=SPOTIFY_MAX_WORKERS) as executor:
+        playlists_tracks = executor.map(
+            lambda playlist: extract_playlist_tracks(playlist, offset=checkpoint.get_offset(playlist['id']), albums=albums),
+            pending_playlists,
+        )
+
+        for playlist, playlist_tracks in zip(pending_playlists, playlists_tracks):
+            # The playlists that the deadline didn't let start have nothing to save
+            if playlist_tracks.next_offset == checkpoint.get_offset(playlist['id']):
+                continue
+
+            checkpoint.write(playlist_tracks)
+            checkpoint.save_if_due()
+
+    checkpoint.save()
+
+    playlists_left = len(playlists) - len(checkpoint.playlists_done)
+    if playlists_left or is_past_deadline():
+        print(f'The time budget ran out with {playlists_left} playlists left')
+        return False
+
+    write_tracks_from_checkpoint(state)
+
+    # Only written after the tracks are uploaded, so the manifest never points to a missing file
     upload_json_to_bucket(
         bucket_name=f'landing-{PROJECT_ID}',
-        json_data=all_playlists,
-        destination_blob_name=f'spotify/tracks/{date.today()}.json',
+        json_data={
+            'date': str(date.today()),
+            'tracks_path': get_part_path('tracks', date.today(), SHARD['index'], 'ndjson'),
+            'playlists': {playlist['id']: playlist.get('snapshot_id') for playlist in playlists},
+        },
+        destination_blob_name=get_snapshot_manifest_path(),
+    )
+
+    return True
+
+
+def get_distinct_ids(values):
+    values = pc.unique(values).drop_null()
+
+    return sorted(values.to_pylist())
+
+@stage('extract_spotify_artists_and_albums')
+def extract_spotify_artists_and_albums():
+    """
+    Gets the full artists and albums of the day's tracks, the tracks only have their ids,
+    names and a partial album. The ids are sent in batches, 50 artists or 20 albums per call.
+    """
+    print('Extract Spotify artists and albums')
+
+    playlists_tracks = read_parquet_from_bucket(
+        f'landing-{PROJECT_ID}',
+        get_part_path('tracks', date.today(), SHARD['index'], 'parquet'),
+        columns=['album_id', 'artist_ids']
     )
 
+    artist_ids = get_distinct_ids(pc.list_flatten(playlists_tracks['artist_ids']))
+    album_ids = get_distinct_ids(playlists_tracks['album_id'])
+
+    print(f'Getting {len(artist_ids)} artists and {len(album_ids)} albums')
+
+    with LandingDatasetWriter('artists', ARTISTS_PARQUET_SCHEMA, flatten_artist) as writer:
+        for artist in get_all_in_batches(get_several_artists, artist_ids, ARTISTS_BATCH_SIZE):
+            writer.write(normalize(ARTIST_RECORD, artist, Artist))
+
+    with LandingDatasetWriter('albums', ALBUMS_PARQUET_SCHEMA, flatten_album) as writer:
+        for album in get_all_in_batches(get_several_albums, album_ids, ALBUMS_BATCH_SIZE):
+            writer.write(normalize(ALBUM_RECORD, album, Album))
+
 
 @functions_framework.http
+@stage('main')
 def main(request):
-    get_secret_manager_secret()
+    """
+    Runs the steps of the extraction of the shard that its checkpoint of the day doesn't
+    have yet. Each shard writes its own part of the landing datasets.
+
+    Returns the status `incomplete` when the time budget ran out, the next invocation
+    resumes from the checkpoint.
+    """
+    global EXTRACTION_DEADLINE, SHARD
+    EXTRACTION_DEADLINE = time.monotonic() + EXTRACT_TIME_BUDGET_SECONDS
+    SHARD = get_shard(request)
+
+    use_shard_spotify_response_cache()
+    state = load_checkpoint_state()
+
+    steps = [
+        ('playlists', extract_spotify_playlists),
+        ('tracks', lambda: extract_spotify_tracks(state)),
+        ('artists_and_albums', extract_spotify_artists_and_albums),
+    ]
+
+    for step_name, run_step in steps:
+        if step_name in state['steps_done']:
+            continue
+
+        if is_past_deadline() or run_step() is False:
+            save_checkpoint_state(state)
+            save_spotify_response_cache()
+
+            print(f'Extraction incomplete, stopped at the step {step_name}')
+            return {'status': 'incomplete', 'step': step_name, 'shard': SHARD['index']}
 
-    get_access_token()
+        state['steps_done'].append(step_name)
+        save_checkpoint_state(state)
 
-    extract_spotify_playlists()
+    save_spotify_response_cache()
 
-    extract_spotify_tracks()
+    # The checkpoints of the runs that never finished are deleted by the bucket lifecycle rule
+    delete_blobs_from_bucket(f'landing-{PROJECT_ID}', get_checkpoint_prefix())
 
-    return 'Extraction completed.'
+    print('Extraction completed.')
+    return {'status': 'complete', 'shard': SHARD['index']}
@@ -0,0 +1,93 @@
+import time
+import zlib
+import base64
+import threading
+from collections import OrderedDict
+
+
+def compress_body(body):
+    # The raw bytes of the response, they are parsed again without being decoded first
+    return base64.b64encode(zlib.compress(body)).decode('ascii')
+
+def decompress_body(compressed_body):
+    return zlib.decompress(base64.b64decode(compressed_body))
+
+
+class ResponseCache:
+    """
+    Bodies and ETags of the Spotify responses, keyed by their path.
+
+    The bodies are kept compressed and in LRU order: past `max_bytes` the least recently
+    used entries are dropped, as are the ones not used for `ttl_seconds`. The entries are
+    plain dicts, so they can be saved as NDJSON and loaded back in the next run.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl_seconds=7 * 24 * 3600):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _is_expired(self, entry):
+        return time.time() - entry['used_at'] > self.ttl_seconds
+
+    def _add(self, entry):
+        previous = self._entries.pop(entry['url'], None)
+        if previous is not None:
+            self._bytes -= len(previous['body'])
+
+        self._entries[entry['url']] = entry
+        self._bytes += len(entry['body'])
+
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted['body'])
+
+    def get(self, url):
+        """
+        Returns the cached etag and compressed body of `url`, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+
+            if entry is None or self._is_expired(entry):
+                return None
+
+            self._entries.move_to_end(url)
+            return entry['etag'], entry['body']
+
+    def put(self, url, etag, body):
+        entry = {'url': url, 'etag': etag, 'body': compress_body(body), 'used_at': time.time()}
+
+        with self._lock:
+            self._add(entry)
+
+    def touch(self, url):
+        # A 304 means the cached body is still the current one
+        with self._lock:
+            self.hits += 1
+
+            if url in self._entries:
+                self._entries[url]['used_at'] = time.time()
+                self._entries.move_to_end(url)
+
+    def load(self, entries):
+        """
+        Adds `entries`, as returned by `dump`.
+        """
+        with self._lock:
+            for entry in entries:
+                if not self._is_expired(entry):
+                    self._add(entry)
+
+    def dump(self):
+        """
+        Returns the entries that are still valid, from the least to the most recently used.
+        """
+        with self._lock:
+            return [entry for entry in self._entries.values() if not self._is_expired(entry)]
@@ -0,0 +1,145 @@
+"""
+Records landed from the Spotify responses.
+
+Each record is declared once as {key: Field | Nested | Many}, with the path of the value in
+the Spotify object. The same declaration gives the `fields=` filter sent to the endpoints
+that support it, so Spotify only sends what is stored, and the `normalize` of the response
+into the record class given with the declaration, a dict by default.
+"""
+from songs_common.records import Image, ArtistReference, AlbumReference
+
+
+class Field:
+    def __init__(self, path):
+        self.path = path.split('.')
+
+class Nested:
+    def __init__(self, path, schema, record=dict):
+        self.path = path.split('.')
+        self.schema = schema
+        self.record = record
+
+class Many(Nested):
+    pass
+
+
+def get_path(item, path):
+    for key in path:
+        if item is None:
+            return None
+
+        item = item.get(key)
+
+    return item
+
+def normalize(schema, item, record=dict):
+    values = {}
+
+    for key, field in schema.items():
+        value = get_path(item, field.path)
+
+        if isinstance(field, Many):
+            value = [normalize(field.schema, element, field.record) for element in value] if value is not None else []
+        elif isinstance(field, Nested) and value is not None:
+            value = normalize(field.schema, value, field.record)
+
+        values[key] = value
+
+    return record(**values)
+
+def get_fields_tree(schema):
+    tree = {}
+
+    for field in schema.values():
+        node = tree
+        for key in field.path[:-1]:
+            node = node.setdefault(key, {})
+
+        leaf = node.setdefault(field.path[-1], {})
+        if isinstance(field, Nested):
+            merge_fields_trees(leaf, get_fields_tree(field.schema))
+
+    return tree
+
+def merge_fields_trees(tree, other):
+    for key, subtree in other.items():
+        merge_fields_trees(tree.setdefault(key, {}), subtree)
+
+def render_fields_tree(tree):
+    return ','.join(f'{key}({render_fields_tree(subtree)})' if subtree else key for key, subtree in tree.items())
+
+def get_fields_filter(schema, items_key='items', page_keys=('next', 'total')):
+    """
+    Returns the `fields` parameter that asks Spotify for the paths of `schema` in each item
+    of a page, e.g. `items(added_at,track(id,name)),next,total`.
+    """
+    return render_fields_tree({items_key: get_fields_tree(schema), **{key: {} for key in page_keys}})
+
+
+###################################################################################
+# Records
+###################################################################################
+
+IMAGE_RECORD = {
+    'url': Field('url'),
+    'height': Field('height'),
+    'width': Field('width'),
+}
+
+ARTIST_REFERENCE_RECORD = {
+    'id': Field('id'),
+    'name': Field('name'),
+}
+
+# An item of /playlists/{id}/tracks, the track is brought to the top level. Normalized into a Track
+PLAYLIST_TRACK_RECORD = {
+    'added_at': Field('added_at'),
+    'is_local': Field('is_local'),
+    'id': Field('track.id'),
+    'name': Field('track.name'),
+    'duration_ms': Field('track.duration_ms'),
+    'explicit': Field('track.explicit'),
+    'album': Nested('track.album', {
+        'id': Field('id'),
+        'name': Field('name'),
+        'release_date': Field('release_date'),
+        'images': Many('images', IMAGE_RECORD, Image),
+    }, AlbumReference),
+    'artists': Many('track.artists', ARTIST_REFERENCE_RECORD, ArtistReference),
+}
+
+PLAYLIST_TRACKS_FIELDS = get_fields_filter(PLAYLIST_TRACK_RECORD)
+
+# /users/{id}/playlists, /artists and /albums don't take `fields`, the records only drop
+# what isn't stored before it is landed
+PLAYLIST_RECORD = {
+    'id': Field('id'),
+    'name': Field('name'),
+    'snapshot_id': Field('snapshot_id'),
+    'owner': Nested('owner', {'id': Field('id')}),
+    'collaborative': Field('collaborative'),
+    'public': Field('public'),
+    'tracks': Nested('tracks', {'total': Field('total')}),
+}
+
+ARTIST_RECORD = {
+    'id': Field('id'),
+    'name': Field('name'),
+    'genres': Field('genres'),
+    'popularity': Field('popularity'),
+    'followers_total': Field('followers.total'),
+    'images': Many('images', IMAGE_RECORD, Image),
+}
+
+ALBUM_RECORD = {
+    'id': Field('id'),
+    'name': Field('name'),
+    'album_type': Field('album_type'),
+    'release_date': Field('release_date'),
+    'release_date_precision': Field('release_date_precision'),
+    'total_tracks': Field('total_tracks'),
+    'label': Field('label'),
+    'popularity': Field('popularity'),
+    'artists': Many('artists', ARTIST_REFERENCE_RECORD, ArtistReference),
+    'images': Many('images', IMAGE_RECORD, Image),
+}
@@ -0,0 +1,160 @@
+import random
+import threading
+import time
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from songs_common.telemetry import record_spotify_call
+from songs_common.codec import loads
+from response_cache import decompress_body
+
+SPOTIFY_BASE_URL = 'https://api.spotify.com/v1'
+SPOTIFY_TOKEN_URL = 'https://accounts.spotify.com/api/token'
+
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 30
+
+# The token is refreshed a bit before Spotify expires it, so a request never goes out with a dead token
+TOKEN_EXPIRY_MARGIN_SECONDS = 60
+
+
+def get_backoff_seconds(attempt, retry_after=None):
+    # Spotify tells how long to wait on a 429, otherwise it's an exponential backoff.
+    # The jitter keeps the workers from hitting the API again all at the same time.
+    if retry_after is not None:
+        return float(retry_after) + random.uniform(0, BACKOFF_BASE_SECONDS)
+
+    backoff = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)
+    return random.uniform(0, backoff)
+
+
+class SpotifyClient:
+    """
+    Keep-alive client for the Spotify Web API.
+
+    The credentials are loaded once through `get_credentials` and the access token is
+    reused until it is about to expire, so warm instances skip both the Secret Manager
+    and the token calls. It is safe to share the client between threads and at most
+    `pool_size` requests are in flight at the same time.
+
+    With a `cache`, the GETs are sent with the ETag of the cached response in `If-None-Match`
+    and a 304 answer reuses the cached body.
+    """
+
+    def __init__(self, get_credentials, pool_size=10, max_retries=5, base_url=SPOTIFY_BASE_URL, token_url=SPOTIFY_TOKEN_URL, cache=None):
+        self.base_url = base_url
+        self.token_url = token_url
+        self.max_retries = max_retries
+        self.cache = cache
+
+        self._get_credentials = get_credentials
+        self._credentials = None
+        self._access_token = None
+        self._token_expires_at = 0
+        self._token_lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(pool_size)
+
+        # Connection errors are retried by urllib3, 429 and 5xx are handled in `get` with the Retry-After header
+        adapter = HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=max_retries, status=0, backoff_factor=BACKOFF_BASE_SECONDS, allowed_methods=None),
+        )
+
+        self.session = Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _load_credentials(self):
+        if self._credentials is None:
+            self._credentials = self._get_credentials()
+
+        return self._credentials
+
+    def _request_access_token(self):
+        credentials = self._load_credentials()
+
+        data = {
+            'grant_type': 'client_credentials',
+            'client_id': credentials.get('spotify_client_id'),
+            'client_secret': credentials.get('spotify_client_secret'),
+        }
+
+        response = self._post_token(data)
+
+        # The secret may have been rotated since it was cached, so it is loaded again once
+        if response.status_code in (400, 401):
+            self._credentials = None
+            credentials = self._load_credentials()
+            data['client_id'] = credentials.get('spotify_client_id')
+            data['client_secret'] = credentials.get('spotify_client_secret')
+
+            response = self._post_token(data)
+
+        response.raise_for_status()
+        return loads(response.content)
+
+    def _post_token(self, data):
+        started_at = time.perf_counter()
+        response = self.session.post(self.token_url, data=data)
+        record_spotify_call(time.perf_counter() - started_at, response.status_code, len(response.content))
+
+        return response
+
+    def get_access_token(self, force_refresh=False):
+        with self._token_lock:
+            if force_refresh or self._access_token is None or time.monotonic() >= self._token_expires_at:
+                print('Getting Spotify access token')
+                token = self._request_access_token()
+
+                self._access_token = token['access_token']
+                self._token_expires_at = time.monotonic() + token.get('expires_in', 3600) - TOKEN_EXPIRY_MARGIN_SECONDS
+
+            return self._access_token
+
+    def get(self, path_or_url):
+        url = path_or_url if path_or_url.startswith('http') else f'{self.base_url}{path_or_url}'
+        token_refreshed = False
+
+        # Keyed by the path, so the entries don't depend on the host the API is reached through
+        cache_key = url[len(self.base_url):] if url.startswith(self.base_url) else url
+        cached = self.cache.get(cache_key) if self.cache is not None else None
+
+        for attempt in range(self.max_retries + 1):
+            headers = {'Authorization': f'Bearer {self.get_access_token()}'}
+            if cached is not None:
+                headers['If-None-Match'] = cached[0]
+
+            with self._in_flight:
+                started_at = time.perf_counter()
+                response = self.session.get(url, headers=headers)
+                record_spotify_call(time.perf_counter() - started_at, response.status_code, len(response.content))
+
+            if response.status_code == 401 and not token_refreshed:
+                token_refreshed = True
+                self.get_access_token(force_refresh=True)
+                continue
+
+            if response.status_code != 429 and response.status_code < 500:
+                break
+
+            if attempt == self.max_retries:
+                break
+
+            wait_seconds = get_backoff_seconds(attempt, response.headers.get('Retry-After'))
+            print(f'Spotify answered {response.status_code}, retrying in {wait_seconds:.1f}s: {url}')
+            time.sleep(wait_seconds)
+
+        if response.status_code == 304 and cached is not None:
+            self.cache.touch(cache_key)
+            return loads(decompress_body(cached[1]))
+
+        response.raise_for_status()
+
+        if self.cache is not None and response.headers.get('ETag'):
+            self.cache.put(cache_key, response.headers['ETag'], response.content)
+
+        return loads(response.content)
+
+    def close(self):
+        self.session.close()
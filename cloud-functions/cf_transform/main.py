@@ -1,17 +1,15 @@
 import functions_framework
 from dotenv import load_dotenv
-import pandas as pd
-import pandas_gbq
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import os
-import json
-from typing import List
-from google.cloud.storage import Blob
-from datetime import date
-from cuid2 import Cuid
-from google.cloud import bigquery
+from songs_common.keys import surrogate_key
+from songs_common.landing import get_landing_range, iterate_parquet_dataset_batches, iterate_parquet_days_from_bucket, list_landed_days, read_json_from_bucket, upload_json_to_bucket
+from songs_common.telemetry import stage
+from songs_common.warehouse import TableLoader
 import asyncio
 
-
 load_dotenv(override=True)
 
 PROJECT_ID = os.getenv('PROJECT_ID')
@@ -26,160 +24,212 @@ TABLE_ID = os.getenv('TABLE_ID')
 if not TABLE_ID:
     raise ValueError("TABLE_ID environment variable not set.")
 
-CUID_GENERATOR: Cuid = Cuid(length=10)
+# The fact is built and loaded in chunks of tracks that fit in FACT_MEMORY_CEILING_MB, 0 builds it in one chunk
+FACT_MEMORY_CEILING_MB = int(os.getenv('FACT_MEMORY_CEILING_MB', '0'))
+
+# Peak memory of a landed track while its chunk is built: a row per artist, its keys and the Parquet of the load
+FACT_BYTES_PER_TRACK_ROW = 4096
+FACT_MIN_CHUNK_ROWS = 1_000
+
+# The columns that make a row of the fact unique, before its keys are computed
+FACT_NATURAL_KEY_COLUMNS = ['playlist_id', 'track_id', 'artist_id', 'is_local', 'added_at']
+
+# [snapshot_id, dim_user_id] of each playlist whose rows are in the fact. The daily runs don't
+# stage the playlists whose version didn't change since, their rows are already in the fact.
+FACT_MANIFEST_PATH = 'spotify/manifests/fact_songs.json'
 
 ###################################################################################
-# Functions to interact with the GCP
+# Steps of the transformation
 ###################################################################################
 
-def retrieve_object_from_bucket(bucket_name, object_path):
-    from google.cloud import storage
-    
-    try:
-        client = storage.Client()
+class HashedKeySet:
+    """
+    The rows already loaded, kept as the sorted 64-bit hashes of their keys: 8 bytes a row,
+    instead of the rows themselves, so the chunks can be deduplicated against each other.
+    """
 
-        bucket = client.get_bucket(bucket_name)
-        blob = bucket.blob(object_path)
-        json_data = blob.download_as_text()
+    def __init__(self):
+        # Sorted runs of hashes, a run is merged with the previous one once it is about as long,
+        # so a chunk is searched in a few runs and each hash is only merged a few times
+        self.runs = []
 
-        print(f"Object '{object_path}' retrieved.")
-        return json.loads(json_data)
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
 
-    except Exception as e:
-        raise Exception(f"Error while getting objects from bucket: {e}")
+    def contains(self, hashes):
+        found = np.zeros(len(hashes), dtype=bool)
 
-def retrieve_blobs_from_bucket(bucket_name, object_path) -> List[Blob]:
-    from google.cloud import storage
-    
-    try:
-        client = storage.Client()
+        for run in self.runs:
+            positions = np.searchsorted(run, hashes).clip(max=len(run) - 1)
+            found |= run[positions] == hashes
 
-        bucket = client.get_bucket(bucket_name)
-        blobs = bucket.list_blobs(prefix=object_path)
+        return found
 
-        print(f"Blobs from '{object_path}' retrieved.")
-        return blobs
+    def add_new(self, table, columns):
+        """
+        Adds the keys of `table` and returns the mask of its rows that were not seen before,
+        neither in `table` nor in the previous chunks.
+        """
+        hashes = hash_rows(table, columns)
 
-    except Exception as e:
-        raise Exception(f"Error while getting blobs from bucket: {e}")
+        _, first_positions = np.unique(hashes, return_index=True)
+        is_new = np.zeros(len(hashes), dtype=bool)
+        is_new[first_positions] = True
+        is_new &= ~self.contains(hashes)
 
-def upload_dataframe_to_bigquery(df, dataset_table):
-    client = bigquery.Client()
+        if is_new.any():
+            self.runs.append(np.sort(hashes[is_new]))
 
-    table = client.get_table(dataset_table)
-    schema = table.schema
+            while len(self.runs) > 1 and len(self.runs[-2]) <= 2 * len(self.runs[-1]):
+                run = self.runs.pop()
+                self.runs[-1] = np.sort(np.concatenate([self.runs[-1], run]), kind='stable')
 
-    job_config = bigquery.LoadJobConfig(
-        write_disposition='WRITE_TRUNCATE',
-        schema=schema
-    )
+        return is_new
 
-    try:
-        job = client.load_table_from_dataframe(df, dataset_table, job_config=job_config)
-        job.result()
+def hash_rows(table, columns):
+    # The hashes only have to match within the process, so the distinct strings of each column
+    # are hashed with hash(), the other values are their own hash, and the rows combine the
+    # hashes of their values
+    hashes = np.zeros(table.num_rows, dtype=np.uint64)
 
-        print(f'Dataframe uploaded to the BigQuery table: {dataset_table}.{PROJECT_ID}')
+    for column in columns:
+        encoded = pc.dictionary_encode(table[column].combine_chunks(), null_encoding='encode')
 
-    except Exception as e:
-        raise Exception(f'An error occurred while uploading dataframe to BigQuery: {e}')
+        if pa.types.is_string(encoded.dictionary.type):
+            value_hashes = np.array([hash(value) for value in encoded.dictionary.to_pylist()], dtype=np.int64)
+        else:
+            value_hashes = encoded.dictionary.cast(pa.int64()).fill_null(hash(None)).to_numpy()
 
-def execute_bigquery_query(query):
-    client = bigquery.Client()
-    query_job = client.query(query)
+        value_hashes = value_hashes.view(np.uint64)
 
-    rows = query_job.result()
+        hashes = hashes * np.uint64(0x100000001B3) ^ value_hashes[encoded.indices.to_numpy()]
 
-    return rows.to_dataframe()
+    return hashes
 
-###################################################################################
-# Steps of the transformation
-###################################################################################
+def map_distinct(column, function):
+    # The ids repeat a lot, so `function` is called once per distinct id
+    encoded = pc.dictionary_encode(column.combine_chunks())
+
+    return pa.array([function(value) for value in encoded.dictionary.to_pylist()], pa.string()).take(encoded.indices)
+
+def get_fact_chunk_rows():
+    # None reads a whole landing day at once
+    if FACT_MEMORY_CEILING_MB <= 0:
+        return None
+
+    return max(FACT_MIN_CHUNK_ROWS, FACT_MEMORY_CEILING_MB * 1024 * 1024 // FACT_BYTES_PER_TRACK_ROW)
+
+def iterate_playlists_tracks(first_day, last_day, columns, chunk_rows):
+    # The newest days first, so the latest value of a row is the one loaded
+    if chunk_rows is None:
+        for _, playlists_tracks in iterate_parquet_days_from_bucket(f'landing-{PROJECT_ID}', 'tracks', first_day, last_day, columns=columns):
+            yield playlists_tracks
+
+        return
+
+    days = list_landed_days(f'landing-{PROJECT_ID}', 'tracks', first_day, last_day)
+    if not days:
+        raise FileNotFoundError(f'landing-{PROJECT_ID}/spotify/tracks/ has no parts from {first_day} to {last_day}')
+
+    # A chunk can split the tracks of a playlist, the rows are deduplicated across chunks and the owners are looked up from all the playlists
+    for day in days:
+        for batch in iterate_parquet_dataset_batches(f'landing-{PROJECT_ID}', 'tracks', day, columns=columns, batch_size=chunk_rows):
+            yield pa.Table.from_batches([batch])
 
-async def create_fact_songs():
+def build_fact_songs_chunk(playlists_tracks, playlists_owners, loaded_keys):
+    # One row per artist of each track
+    artists_tracks_indices = pc.list_parent_indices(playlists_tracks['artist_ids'])
+
+    songs = playlists_tracks.select(['playlist_id', 'track_id', 'is_local', 'added_at']).take(artists_tracks_indices)
+    songs = songs.append_column('artist_id', pc.list_flatten(playlists_tracks['artist_ids']))
+    songs = songs.filter(pa.array(loaded_keys.add_new(songs, FACT_NATURAL_KEY_COLUMNS)))
+
+    # The keys are the same ones the dimensions compute, so there is nothing to read from BigQuery
+    return pa.table({
+        'dim_playlist_id': map_distinct(songs['playlist_id'], lambda playlist_id: surrogate_key('spotify', playlist_id)),
+        'dim_artist_id': map_distinct(songs['artist_id'], lambda artist_id: surrogate_key('spotify', artist_id)),
+        'dim_track_id': map_distinct(songs['track_id'], lambda track_id: surrogate_key('spotify', track_id)),
+        'dim_user_id': map_distinct(songs['playlist_id'], playlists_owners.get),
+        'dim_platform_id': pa.repeat('spotify', songs.num_rows),
+        'added_at': songs['added_at'], # Parsed when it was landed
+        'is_local': songs['is_local'],
+    })
+
+def read_fact_manifest():
+    try:
+        return read_json_from_bucket(f'landing-{PROJECT_ID}', FACT_MANIFEST_PATH)['playlists']
+    except FileNotFoundError:
+        return {} # The first load, or the manifest was deleted to stage every playlist again
+
+def get_unchanged_playlist_ids(playlists_versions, loaded_versions):
+    # A playlist without a snapshot_id can't be compared, its rows are always staged
+    return [
+        playlist_id
+        for playlist_id, version in playlists_versions.items()
+        if version[0] is not None and loaded_versions.get(playlist_id) == version
+    ]
+
+async def create_fact_songs(first_day, last_day, incremental):
     print('CREATE FACT SONGS')
 
-    users_playlists = retrieve_object_from_bucket(f'landing-{PROJECT_ID}', f'spotify/playlists/{date.today()}.json')
-    playlists_tracks = retrieve_object_from_bucket(f'landing-{PROJECT_ID}', f'spotify/tracks/{date.today()}.json')
-
-    # TODO: get all of these table ids from env variables
-    dim_playlist_df = execute_bigquery_query("""
-    SELECT *
-    FROM prep_songs_dimensions.dim_playlist
-    """)
-    dim_artist_df = execute_bigquery_query("""
-    SELECT *
-    FROM prep_songs_dimensions.dim_artist
-    """)
-    dim_track_df = execute_bigquery_query("""
-    SELECT *
-    FROM prep_songs_dimensions.dim_track
-    """)
-    dim_user_df = execute_bigquery_query("""
-    SELECT *
-    FROM prep_songs_dimensions.dim_user
-    """)
-
-    songs = []
-
-    for playlist_tracks in playlists_tracks:
-        playlist_id = playlist_tracks['playlist_id']
-
-        spotify_user_id = None
-
-        for user_playlists in users_playlists:
-            for playlist in user_playlists['playlists']:
-                if playlist['id'] == playlist_id:
-                    spotify_user_id = user_playlists['spotify_id']
-
-                    break
-        
-        for track in playlist_tracks['tracks']:
-            track_id = track['id']
-            added_at = track['added_at']
-            is_local = track['is_local']
-            artists = track.get('artists', [])
-
-            for artist in artists:
-                songs.append({
-                    'playlist_id': playlist_id,
-                    'artist_id': artist['id'],
-                    'track_id': track_id,
-                    'spotify_id': spotify_user_id,
-                    'dim_platform_id': 'spotify',
-                    'is_local': is_local,
-                    'added_at': added_at,
-                })
-
-    fact_songs_df = pd.DataFrame(songs).drop_duplicates()
-
-    fact_songs_df = pd.merge(fact_songs_df, dim_playlist_df, how='left', left_on='playlist_id', right_on='dim_playlist_id')
-    fact_songs_df = pd.merge(fact_songs_df, dim_artist_df, how='left', left_on='artist_id', right_on='dim_artist_id')
-    fact_songs_df = pd.merge(fact_songs_df, dim_track_df, how='left', left_on='track_id', right_on='dim_track_id')
-
-    fact_songs_df = pd.merge(fact_songs_df, dim_user_df[['spotify_id', 'dim_user_id']], how='left', on='spotify_id')
-
-    fact_songs_df = fact_songs_df[[
-        'dim_playlist_id',
-        'dim_artist_id',
-        'dim_track_id',
-        'dim_user_id',
-        'dim_platform_id',
-        'added_at',
-        'is_local',
-    ]]
-
-    fact_songs_df['added_at'] = pd.to_datetime(fact_songs_df['added_at'], errors='coerce')
-
-    upload_dataframe_to_bigquery(
-        fact_songs_df,
-        f'{DATASET_ID}.{TABLE_ID}'
+    playlists_versions = {}
+
+    for _, users_playlists in iterate_parquet_days_from_bucket(f'landing-{PROJECT_ID}', 'playlists', first_day, last_day, columns=['dim_user_id', 'playlist_id', 'snapshot_id']):
+        for playlist_id, dim_user_id, snapshot_id in zip(users_playlists['playlist_id'].to_pylist(), users_playlists['dim_user_id'].to_pylist(), users_playlists['snapshot_id'].to_pylist()):
+            playlists_versions.setdefault(playlist_id, [snapshot_id, dim_user_id])
+
+    playlists_owners = {playlist_id: version[1] for playlist_id, version in playlists_versions.items()}
+
+    chunk_rows = get_fact_chunk_rows()
+    loaded_keys = HashedKeySet()
+
+    print(f'Building the fact in chunks of {chunk_rows} tracks' if chunk_rows else 'Building the fact in one chunk')
+
+    # Each chunk is loaded as soon as it is built, the chunks never share a row. The rows of
+    # all the days of a backfill are merged at once. The fact is clustered on dim_playlist_id,
+    # so the merge only reads the blocks of the playlists staged.
+    loader = TableLoader(
+        f'{DATASET_ID}.{TABLE_ID}',
+        key_columns=['dim_playlist_id', 'dim_artist_id', 'dim_track_id', 'dim_user_id', 'dim_platform_id', 'added_at'],
+        partition_column='added_at',
+        cluster_column='dim_playlist_id'
     )
 
-async def create_all_tables():
-    await create_fact_songs()
+    # A truncate rewrites the fact, a backfill stages every playlist again
+    loaded_versions = read_fact_manifest() if loader.mode == 'merge' else {}
+    unchanged_playlist_ids = pa.array(get_unchanged_playlist_ids(playlists_versions, loaded_versions) if incremental else [], pa.string())
+
+    print(f'{len(playlists_versions) - len(unchanged_playlist_ids)} of {len(playlists_versions)} playlists staged, the others are unchanged since the last load')
+
+    with loader:
+        for playlists_tracks in iterate_playlists_tracks(first_day, last_day, ['playlist_id', 'track_id', 'artist_ids', 'is_local', 'added_at'], chunk_rows):
+            if len(unchanged_playlist_ids):
+                playlists_tracks = playlists_tracks.filter(pc.invert(pc.is_in(playlists_tracks['playlist_id'], value_set=unchanged_playlist_ids)))
+
+            fact_songs = build_fact_songs_chunk(playlists_tracks, playlists_owners, loaded_keys)
+
+            if fact_songs.num_rows == 0 and loader.chunks:
+                continue
+
+            loader.append(fact_songs)
+
+    # Only written once the rows are in the fact, so the manifest never lists a playlist whose rows are missing
+    upload_json_to_bucket(f'landing-{PROJECT_ID}', {'playlists': {**loaded_versions, **playlists_versions}}, FACT_MANIFEST_PATH)
+
+    print(f'{len(loaded_keys)} rows staged into the fact')
+
+async def create_all_tables(first_day, last_day, incremental):
+    with stage('create_fact_songs'):
+        await create_fact_songs(first_day, last_day, incremental)
+
+def is_backfill(request):
+    payload = request.get_json(silent=True) if request is not None else None
+
+    return bool((payload or {}).get('backfill'))
 
 @functions_framework.http
+@stage('main')
 def main(request):
-    asyncio.run(create_all_tables())
+    asyncio.run(create_all_tables(*get_landing_range(request), incremental=not is_backfill(request)))
 
     return 'Transformation completed.'
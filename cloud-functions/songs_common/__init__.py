@@ -0,0 +1 @@
+"""Code shared by the cloud functions, it is bundled into each function on deploy."""
@@ -0,0 +1,21 @@
+"""
+JSON codec of the landing files, the checkpoints and the Spotify responses.
+
+orjson parses and writes JSON several times faster than the json module, and serializes
+the dataclasses of songs_common.records as they are, without building a dict first.
+"""
+import orjson
+
+
+def loads(data):
+    """
+    Parses `data`, bytes or str.
+    """
+    return orjson.loads(data)
+
+def dumps(value) -> bytes:
+    return orjson.dumps(value)
+
+def dumps_line(value) -> bytes:
+    # One line of NDJSON
+    return orjson.dumps(value, option=orjson.OPT_APPEND_NEWLINE)
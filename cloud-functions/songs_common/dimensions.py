@@ -0,0 +1,125 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+from concurrent.futures import ThreadPoolExecutor
+from songs_common.keys import surrogate_key
+from songs_common.landing import iterate_parquet_days_from_bucket
+from songs_common.warehouse import upload_table_to_bigquery
+
+DIMENSIONS_MAX_WORKERS = 4
+
+
+###################################################################################
+# Members of each dimension
+###################################################################################
+
+# Each collect adds to `members` the {natural id: name} of a record batch of its landing dataset.
+# The first name seen for an id is kept and the newest days are read first, so a backfill keeps
+# the latest name, like the daily merges do.
+
+def add_members(members, natural_ids, names):
+    for natural_id, name in zip(natural_ids, names):
+        # Local files have no Spotify id, so they are left out of the dimensions
+        if natural_id is not None and natural_id not in members:
+            members[natural_id] = name
+
+def collect_artists(batch, members):
+    add_members(members, pc.list_flatten(batch['artist_ids']).to_pylist(), pc.list_flatten(batch['artist_names']).to_pylist())
+
+def collect_tracks(batch, members):
+    add_members(members, batch['track_id'].to_pylist(), batch['track_name'].to_pylist())
+
+def collect_playlists(batch, members):
+    add_members(members, batch['playlist_id'].to_pylist(), batch['name'].to_pylist())
+
+# The landing dataset and columns each dimension is built from, the dimensions of the same
+# dataset are built in the same scan of it
+DIMENSIONS = {
+    'dim_platform': {
+        'key_column': 'dim_platform_id',
+        'dataset': None,
+        'columns': [],
+        'collect': None,
+        'members': {'spotify': 'Spotify'},
+        'get_key': lambda natural_id: natural_id,
+    },
+    'dim_artist': {
+        'key_column': 'dim_artist_id',
+        'dataset': 'tracks',
+        'columns': ['artist_ids', 'artist_names'],
+        'collect': collect_artists,
+        'get_key': lambda natural_id: surrogate_key('spotify', natural_id),
+    },
+    'dim_track': {
+        'key_column': 'dim_track_id',
+        'dataset': 'tracks',
+        'columns': ['track_id', 'track_name'],
+        'collect': collect_tracks,
+        'get_key': lambda natural_id: surrogate_key('spotify', natural_id),
+    },
+    'dim_playlist': {
+        'key_column': 'dim_playlist_id',
+        'dataset': 'playlists',
+        'columns': ['playlist_id', 'name'],
+        'collect': collect_playlists,
+        'get_key': lambda natural_id: surrogate_key('spotify', natural_id),
+    },
+}
+
+
+###################################################################################
+# Engine
+###################################################################################
+
+def collect_members(bucket_name, first_day, last_day, names):
+    """
+    Returns the {natural id: name} of each dimension in `names`, reading each landing
+    dataset of the days from `first_day` to `last_day` once with the columns of all the
+    dimensions built from it.
+    """
+    members = {name: dict(DIMENSIONS[name].get('members', {})) for name in names}
+
+    datasets = {}
+    for name in names:
+        if DIMENSIONS[name]['dataset'] is not None:
+            datasets.setdefault(DIMENSIONS[name]['dataset'], []).append(name)
+
+    for dataset, dataset_names in datasets.items():
+        columns = list(dict.fromkeys(column for name in dataset_names for column in DIMENSIONS[name]['columns']))
+        for _, table in iterate_parquet_days_from_bucket(bucket_name, dataset, first_day, last_day, columns=columns):
+            for batch in table.to_batches():
+                for name in dataset_names:
+                    DIMENSIONS[name]['collect'](batch, members[name])
+
+    return members
+
+def get_dimension_table(name, members):
+    dimension = DIMENSIONS[name]
+
+    return pa.table({
+        dimension['key_column']: pa.array([dimension['get_key'](natural_id) for natural_id in members], pa.string()),
+        'name': pa.array(list(members.values()), pa.string()),
+    })
+
+def build_dimensions(dataset_tables, bucket_name, first_day, last_day):
+    """
+    Builds the dimensions of `dataset_tables`, {dimension: BigQuery dataset.table}, from
+    the landing data of the days from `first_day` to `last_day` and loads them into their
+    tables at the same time. Returns the number of members of each dimension.
+    """
+    members = collect_members(bucket_name, first_day, last_day, list(dataset_tables))
+
+    for name, dimension_members in members.items():
+        print(f'{len(dimension_members)} members in {name}')
+
+    def load(name):
+        upload_table_to_bigquery(
+            get_dimension_table(name, members[name]),
+            dataset_tables[name],
+            key_columns=[DIMENSIONS[name]['key_column']],
+        )
+
+    with ThreadPoolExecutor(max_workers=min(DIMENSIONS_MAX_WORKERS, len(dataset_tables))) as executor:
+        # list() raises the error of the first load that failed
+        list(executor.map(load, dataset_tables))
+
+    return {name: len(dimension_members) for name, dimension_members in members.items()}
@@ -0,0 +1,58 @@
+import os
+import threading
+
+# One client per service for the whole process, so warm instances reuse them and their connections.
+# The google.cloud packages take hundreds of ms to import, so each one is imported with its first client.
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_project_id():
+    # Given to the clients, otherwise each one asks the metadata server for the project.
+    # Read when the client is created, the functions load their .env after the imports.
+    return os.getenv('PROJECT_ID')
+
+
+def get_storage_client():
+    with _CLIENTS_LOCK:
+        if 'storage' not in _CLIENTS:
+            from google.cloud import storage
+
+            _CLIENTS['storage'] = storage.Client(project=get_project_id()) # There is no need to use from_service_account_json because in the CF it can authenticate normally.
+
+        return _CLIENTS['storage']
+
+
+def get_bucket(bucket_name):
+    # client.bucket doesn't call the API, unlike client.get_bucket
+    return get_storage_client().bucket(bucket_name)
+
+
+def get_bigquery_client():
+    with _CLIENTS_LOCK:
+        if 'bigquery' not in _CLIENTS:
+            from google.cloud import bigquery
+
+            _CLIENTS['bigquery'] = bigquery.Client(project=get_project_id())
+
+        return _CLIENTS['bigquery']
+
+
+def get_bigquery_storage_client():
+    with _CLIENTS_LOCK:
+        if 'bigquery_storage' not in _CLIENTS:
+            from google.cloud import bigquery_storage
+
+            _CLIENTS['bigquery_storage'] = bigquery_storage.BigQueryReadClient()
+
+        return _CLIENTS['bigquery_storage']
+
+
+def get_secret_manager_client():
+    with _CLIENTS_LOCK:
+        if 'secret_manager' not in _CLIENTS:
+            from google.cloud import secretmanager
+
+            _CLIENTS['secret_manager'] = secretmanager.SecretManagerServiceClient()
+
+        return _CLIENTS['secret_manager']
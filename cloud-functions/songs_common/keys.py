@@ -0,0 +1,16 @@
+import hashlib
+
+KEY_DIGEST_SIZE = 10
+
+
+def surrogate_key(platform, natural_id):
+    """
+    Surrogate key of a dimension member, built from its platform and its id in the platform.
+
+    The same member always gets the same key, so the dimensions and the facts can be built
+    independently and still join, without reading the keys back from BigQuery.
+    """
+    if natural_id is None:
+        return None
+
+    return hashlib.blake2b(f'{platform}:{natural_id}'.encode('utf-8'), digest_size=KEY_DIGEST_SIZE).hexdigest()
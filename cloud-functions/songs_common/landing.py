@@ -0,0 +1,461 @@
+import os
+import gzip
+import time
+import hashlib
+import threading
+import pyarrow as pa
+import pyarrow.parquet as pq
+from collections import deque
+from datetime import date
+from typing import Dict, Iterator, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from songs_common.gcp import get_bucket
+from songs_common.codec import dumps, dumps_line, loads
+from songs_common.telemetry import add_rows, record_call, timed_call
+
+LANDING_CHUNK_SIZE = 8 * 1024 * 1024 # Must be a multiple of 256 KB for the resumable upload
+LANDING_PARQUET_ROW_GROUP_SIZE = 50_000
+PARQUET_READ_CHUNK_SIZE = 1024 * 1024
+
+# /tmp lives in the instance memory, so the cache is capped
+LANDING_CACHE_DIR = os.getenv('LANDING_CACHE_DIR', '/tmp/landing-cache')
+LANDING_CACHE_MAX_BYTES = int(os.getenv('LANDING_CACHE_MAX_MB', '128')) * 1024 * 1024
+
+# The parts and the days are read by several threads, one eviction at a time
+_CACHE_EVICTION_LOCK = threading.Lock()
+
+PARQUET_PARTS_MAX_WORKERS = 8
+
+# Days of a backfill downloaded ahead of the one being processed
+LANDING_DAYS_PREFETCH = 2
+
+
+###################################################################################
+# Paths
+###################################################################################
+
+# Each extraction shard writes its own part of a dataset: spotify/<dataset>/<date>/part-NNNN.<extension>
+def get_dataset_prefix(dataset, day):
+    return f'spotify/{dataset}/{day}/'
+
+def get_part_path(dataset, day, part_index, extension):
+    return f'{get_dataset_prefix(dataset, day)}part-{part_index:04d}.{extension}'
+
+def list_dataset_parts(bucket_name, dataset, day, extension):
+    with timed_call('gcs'):
+        blobs = get_bucket(bucket_name).list_blobs(prefix=get_dataset_prefix(dataset, day))
+
+        return sorted(blob.name for blob in blobs if blob.name.endswith(f'.{extension}'))
+
+def list_landed_days(bucket_name, dataset, first_day, last_day):
+    """
+    Returns the days from `first_day` to `last_day`, both included, that have Parquet parts
+    of the dataset, newest first. A single day is returned without listing the bucket.
+    """
+    if first_day == last_day:
+        return [first_day]
+
+    with timed_call('gcs'):
+        blobs = get_bucket(bucket_name).list_blobs(prefix=f'spotify/{dataset}/')
+        days = {date.fromisoformat(blob.name.split('/')[2]) for blob in blobs if blob.name.endswith('.parquet')}
+
+    return sorted((day for day in days if first_day <= day <= last_day), reverse=True)
+
+def get_landing_range(request) -> Tuple[date, date]:
+    """
+    Reads the landing days of the invocation from the request body, e.g.
+    {"backfill": {"start_date": "2024-01-01", "end_date": "2024-01-31"}}, both included and
+    end_date today when it is missing. Without a backfill, the invocation reads today.
+    """
+    payload = request.get_json(silent=True) if request is not None else None
+    backfill = (payload or {}).get('backfill')
+
+    if not backfill:
+        return date.today(), date.today()
+
+    try:
+        first_day = date.fromisoformat(backfill['start_date'])
+        last_day = date.fromisoformat(backfill['end_date']) if backfill.get('end_date') else date.today()
+
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f'Invalid backfill {backfill}: {e}')
+
+    if first_day > last_day:
+        raise ValueError(f'The backfill starts after it ends: {first_day} > {last_day}')
+
+    print(f'Backfill from {first_day} to {last_day}')
+    return first_day, last_day
+
+
+###################################################################################
+# Writers
+###################################################################################
+
+class NdjsonBlobWriter:
+    """
+    Writes records to a blob as newline-delimited JSON while they are being produced.
+
+    The blob goes through a resumable upload sent in chunks of `chunk_size`, so the
+    memory used doesn't depend on the number of records. With `compress` the content
+    is gzipped and the blob is stored with `Content-Encoding: gzip`. `encode` turns each
+    record into the lines written for it, like records.TracksEncoder, by default the
+    record itself.
+    """
+
+    def __init__(self, bucket_name, destination_blob_name, compress=True, chunk_size=LANDING_CHUNK_SIZE, encode=None):
+        self.bucket_name = bucket_name
+        self.destination_blob_name = destination_blob_name.lstrip('/')
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.encode = encode
+        self.count = 0
+
+    def __enter__(self):
+        try:
+            blob = get_bucket(self.bucket_name).blob(self.destination_blob_name, chunk_size=self.chunk_size)
+            if self.compress:
+                blob.content_encoding = 'gzip'
+
+            self._blob_file = blob.open('wb', content_type='application/x-ndjson', ignore_flush=True)
+            self._file = gzip.GzipFile(fileobj=self._blob_file, mode='wb') if self.compress else self._blob_file
+
+        except Exception as e:
+            raise Exception(f'Error opening {self.bucket_name}/{self.destination_blob_name}: {str(e)}')
+
+        return self
+
+    def write(self, record):
+        # A dict or a record of songs_common.records
+        if self.encode is None:
+            self._file.write(dumps_line(record))
+        else:
+            self._file.write(b''.join(dumps_line(line) for line in self.encode(record)))
+
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Without closing the writer the resumable upload is never finalized, so a failed
+        # extraction doesn't leave a partial file behind
+        if exc_type is not None:
+            return False
+
+        try:
+            started_at = time.perf_counter()
+
+            if self.compress:
+                self._file.close()
+
+            bytes_uploaded = self._blob_file.tell()
+            self._blob_file.close()
+
+            record_call('gcs', time.perf_counter() - started_at, bytes_uploaded=bytes_uploaded)
+
+            print(f'{self.count} records uploaded to {self.bucket_name}/{self.destination_blob_name}')
+
+        except Exception as e:
+            raise Exception(f'Error uploading records to {self.bucket_name}: {str(e)}')
+
+        return False
+
+class ParquetBlobWriter:
+    """
+    Writes records to a blob as Parquet while they are being produced.
+
+    `flatten` turns each record into the rows of `schema`, which are written as a row group
+    every `row_group_size` rows, so only one row group is kept in memory.
+    """
+
+    def __init__(self, bucket_name, destination_blob_name, schema, flatten, row_group_size=LANDING_PARQUET_ROW_GROUP_SIZE, chunk_size=LANDING_CHUNK_SIZE):
+        self.bucket_name = bucket_name
+        self.destination_blob_name = destination_blob_name.lstrip('/')
+        self.schema = schema
+        self.flatten = flatten
+        self.row_group_size = row_group_size
+        self.chunk_size = chunk_size
+        self.count = 0
+        self._columns = {field.name: [] for field in schema}
+
+    def __enter__(self):
+        try:
+            blob = get_bucket(self.bucket_name).blob(self.destination_blob_name, chunk_size=self.chunk_size)
+
+            self._blob_file = blob.open('wb', content_type='application/vnd.apache.parquet', ignore_flush=True)
+            self._writer = pq.ParquetWriter(self._blob_file, self.schema, compression='zstd')
+
+        except Exception as e:
+            raise Exception(f'Error opening {self.bucket_name}/{self.destination_blob_name}: {str(e)}')
+
+        return self
+
+    def write(self, record):
+        for row in self.flatten(record):
+            for name, values in self._columns.items():
+                values.append(row.get(name))
+
+            self.count += 1
+
+        if len(self._columns[self.schema[0].name]) >= self.row_group_size:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        arrays = []
+
+        for field in self.schema:
+            values = self._columns[field.name]
+
+            # Spotify sends the timestamps as ISO 8601 strings, Arrow parses them in the cast
+            if pa.types.is_timestamp(field.type):
+                arrays.append(pa.array(values, pa.string()).cast(field.type))
+            else:
+                arrays.append(pa.array(values, field.type))
+
+            values.clear()
+
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            return False
+
+        try:
+            if self._columns[self.schema[0].name]:
+                self._write_row_group()
+
+            started_at = time.perf_counter()
+
+            self._writer.close()
+
+            bytes_uploaded = self._blob_file.tell()
+            self._blob_file.close()
+
+            record_call('gcs', time.perf_counter() - started_at, bytes_uploaded=bytes_uploaded)
+            add_rows(self.count)
+
+            print(f'{self.count} rows uploaded to {self.bucket_name}/{self.destination_blob_name}')
+
+        except Exception as e:
+            raise Exception(f'Error uploading rows to {self.bucket_name}: {str(e)}')
+
+        return False
+
+def upload_json_to_bucket(bucket_name, json_data, destination_blob_name):
+    try:
+        data = dumps(json_data)
+
+        blob = get_bucket(bucket_name).blob(destination_blob_name)
+        with timed_call('gcs', bytes_uploaded=len(data)):
+            blob.upload_from_string(data, content_type='application/json')
+
+        print(f'JSON data uploaded to {bucket_name}/{destination_blob_name}')
+
+    except Exception as e:
+        raise Exception(f'Error uploading json to {bucket_name}: {str(e)}')
+
+
+###################################################################################
+# Readers
+###################################################################################
+
+def get_landing_blob(bucket_name, object_path):
+    with timed_call('gcs'):
+        blob = get_bucket(bucket_name).get_blob(object_path)
+
+    if blob is None:
+        raise FileNotFoundError(f'{bucket_name}/{object_path} does not exist')
+
+    return blob
+
+def read_json_from_bucket(bucket_name, object_path):
+    # A missing object raises FileNotFoundError, left to the caller
+    blob = get_landing_blob(bucket_name, object_path)
+
+    with timed_call('gcs'):
+        json_data = blob.download_as_bytes()
+
+    print(f"Object '{object_path}' retrieved.")
+    return loads(json_data)
+
+def iterate_ndjson_from_bucket(bucket_name, object_path) -> Iterator[Dict]:
+    try:
+        blob = get_landing_blob(bucket_name, object_path)
+
+        started_at = time.perf_counter()
+
+        # The gzip is decompressed here, GCS doesn't support ranged reads of transcoded objects
+        with blob.open('rb', chunk_size=LANDING_CHUNK_SIZE, raw_download=True) as blob_file:
+            file = gzip.GzipFile(fileobj=blob_file) if blob.content_encoding == 'gzip' else blob_file
+
+            for line in file:
+                if line.strip():
+                    yield loads(line)
+
+            bytes_downloaded = blob_file.tell()
+
+        # Includes the time the caller spent with each record, the stream is read as it is consumed
+        record_call('gcs', time.perf_counter() - started_at, bytes_downloaded=bytes_downloaded)
+
+        print(f"Object '{object_path}' retrieved.")
+
+    # A missing object is left to the caller, it costs one call less than checking it exists first
+    except FileNotFoundError:
+        raise
+
+    except Exception as e:
+        raise Exception(f"Error while getting objects from bucket: {e}")
+
+def get_cache_path(blob, columns):
+    # A new upload gets a new generation, so an entry never has to be invalidated
+    key = dumps([blob.bucket.name, blob.name, blob.generation, columns])
+
+    return os.path.join(LANDING_CACHE_DIR, hashlib.sha256(key).hexdigest() + '.arrow')
+
+def evict_cache_entries():
+    with _CACHE_EVICTION_LOCK:
+        entries = []
+
+        for entry in os.scandir(LANDING_CACHE_DIR):
+            if not entry.name.endswith('.arrow'):
+                continue
+
+            # Already gone if it was removed since the scan
+            try:
+                entries.append((entry.path, entry.stat()))
+            except FileNotFoundError:
+                pass
+
+        # The most recently written or read first, see read_parquet_from_bucket
+        entries.sort(key=lambda item: item[1].st_mtime, reverse=True)
+
+        used_bytes = 0
+
+        for path, stat in entries:
+            used_bytes += stat.st_size
+
+            if used_bytes > LANDING_CACHE_MAX_BYTES:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+def read_parquet_from_bucket(bucket_name, object_path, columns=None) -> pa.Table:
+    """
+    Reads the `columns` of a Parquet blob.
+
+    The table read is cached in /tmp as an Arrow file keyed by the blob name, generation
+    and columns, so warm instances and retries of the same day only pay for a metadata
+    call and a memory-mapped read.
+    """
+    try:
+        blob = get_landing_blob(bucket_name, object_path)
+        cache_path = get_cache_path(blob, columns)
+
+        # The entry can be evicted between the check and the read, then the blob is downloaded
+        try:
+            # Marks the entry as used, reading it through the memory map doesn't update st_atime on relatime and noatime mounts
+            os.utime(cache_path)
+
+            with pa.memory_map(cache_path) as source:
+                table = pa.ipc.open_file(source).read_all()
+
+            print(f"Object '{object_path}' retrieved from the cache.")
+            return table
+
+        except FileNotFoundError:
+            pass
+
+        # Only the footer and the column chunks of `columns` are downloaded
+        with timed_call('gcs'):
+            with blob.open('rb', chunk_size=PARQUET_READ_CHUNK_SIZE) as blob_file:
+                table = pq.read_table(blob_file, columns=columns)
+
+        os.makedirs(LANDING_CACHE_DIR, exist_ok=True)
+
+        # Written under a temporary name, so a concurrent read never sees a partial file
+        temporary_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with pa.OSFile(temporary_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(temporary_path, cache_path)
+
+        evict_cache_entries()
+
+        print(f"Object '{object_path}' retrieved.")
+        return table
+
+    except Exception as e:
+        raise Exception(f"Error while getting objects from bucket: {e}")
+
+def iterate_ndjson_dataset_from_bucket(bucket_name, dataset, day) -> Iterator[Dict]:
+    """
+    Iterates the records of every NDJSON part of a landing dataset.
+    """
+    for part_path in list_dataset_parts(bucket_name, dataset, day, 'ndjson'):
+        yield from iterate_ndjson_from_bucket(bucket_name, part_path)
+
+def read_parquet_dataset_from_bucket(bucket_name, dataset, day, columns=None) -> pa.Table:
+    """
+    Reads the `columns` of every Parquet part of a landing dataset as one table.
+    The parts are downloaded at the same time.
+    """
+    part_paths = list_dataset_parts(bucket_name, dataset, day, 'parquet')
+
+    if not part_paths:
+        raise FileNotFoundError(f'{bucket_name}/{get_dataset_prefix(dataset, day)} has no parts')
+
+    with ThreadPoolExecutor(max_workers=min(PARQUET_PARTS_MAX_WORKERS, len(part_paths))) as executor:
+        tables = list(executor.map(lambda part_path: read_parquet_from_bucket(bucket_name, part_path, columns=columns), part_paths))
+
+    return pa.concat_tables(tables)
+
+def iterate_parquet_dataset_batches(bucket_name, dataset, day, columns=None, batch_size=LANDING_PARQUET_ROW_GROUP_SIZE) -> Iterator[pa.RecordBatch]:
+    """
+    Iterates the `columns` of every Parquet part of a landing dataset in record batches of
+    at most `batch_size` rows. Only the row group being read is kept in memory, so the
+    dataset doesn't have to fit in it. Unlike read_parquet_from_bucket, nothing is cached.
+    """
+    part_paths = list_dataset_parts(bucket_name, dataset, day, 'parquet')
+
+    if not part_paths:
+        raise FileNotFoundError(f'{bucket_name}/{get_dataset_prefix(dataset, day)} has no parts')
+
+    for part_path in part_paths:
+        blob = get_landing_blob(bucket_name, part_path)
+
+        try:
+            started_at = time.perf_counter()
+
+            with blob.open('rb', chunk_size=PARQUET_READ_CHUNK_SIZE) as blob_file:
+                yield from pq.ParquetFile(blob_file).iter_batches(batch_size=batch_size, columns=columns)
+
+            # Includes the time the caller spent with each batch, like iterate_ndjson_from_bucket
+            record_call('gcs', time.perf_counter() - started_at)
+
+            print(f"Object '{part_path}' retrieved.")
+
+        except Exception as e:
+            raise Exception(f"Error while getting objects from bucket: {e}")
+
+def iterate_parquet_days_from_bucket(bucket_name, dataset, first_day, last_day, columns=None) -> Iterator[Tuple[date, pa.Table]]:
+    """
+    Iterates the `columns` of a landing dataset day by day, newest first, as in
+    list_landed_days. The next LANDING_DAYS_PREFETCH days are downloaded while the caller
+    works on the current one.
+    """
+    days = list_landed_days(bucket_name, dataset, first_day, last_day)
+
+    if not days:
+        raise FileNotFoundError(f'{bucket_name}/spotify/{dataset}/ has no parts from {first_day} to {last_day}')
+
+    with ThreadPoolExecutor(max_workers=LANDING_DAYS_PREFETCH + 1) as executor:
+        downloads = deque()
+
+        for day in days:
+            downloads.append((day, executor.submit(read_parquet_dataset_from_bucket, bucket_name, dataset, day, columns=columns)))
+
+            if len(downloads) > LANDING_DAYS_PREFETCH:
+                day, download = downloads.popleft()
+                yield day, download.result()
+
+        while downloads:
+            day, download = downloads.popleft()
+            yield day, download.result()
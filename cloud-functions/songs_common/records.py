@@ -0,0 +1,187 @@
+"""
+Typed records of the landing datasets.
+
+The classes have __slots__, so a record takes a fraction of the memory of the dict it
+replaces, and songs_common.codec writes them as the same JSON objects.
+
+The tracks files are normalised: each album and artist is written once, in an
+{"album": ...} or {"artist": ...} line before the first playlist line that refers to
+it, and the tracks refer to them by id. TracksEncoder writes them and
+iterate_playlists_tracks rebuilds the nested PlaylistTracks.
+"""
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional
+
+
+@dataclass(slots=True)
+class Image:
+    url: Optional[str]
+    height: Optional[int]
+    width: Optional[int]
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value.get('url'), value.get('height'), value.get('width'))
+
+@dataclass(slots=True)
+class ArtistReference:
+    id: Optional[str]
+    name: Optional[str]
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value.get('id'), value.get('name'))
+
+@dataclass(slots=True)
+class AlbumReference:
+    # The album of a track, only what the playlist tracks endpoint is asked for
+    id: Optional[str]
+    name: Optional[str]
+    release_date: Optional[str]
+    images: List[Image]
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value.get('id'), value.get('name'), value.get('release_date'), [Image.from_dict(image) for image in value.get('images') or []])
+
+@dataclass(slots=True)
+class Track:
+    added_at: Optional[str]
+    is_local: Optional[bool]
+    id: Optional[str]
+    name: Optional[str]
+    duration_ms: Optional[int]
+    explicit: Optional[bool]
+    album: Optional[AlbumReference]
+    artists: List[ArtistReference]
+
+    @classmethod
+    def from_dict(cls, value, albums=None, artists=None):
+        # The album and the artists are ids of the lookups of a normalised file, or the
+        # objects themselves in the files written before and for the ones without an id
+        album = value.get('album')
+
+        if isinstance(album, str):
+            album = albums[album]
+        elif album is not None:
+            album = get_shared_album(AlbumReference.from_dict(album), albums)
+
+        return cls(
+            value.get('added_at'),
+            value.get('is_local'),
+            value.get('id'),
+            value.get('name'),
+            value.get('duration_ms'),
+            value.get('explicit'),
+            album,
+            [artists[artist] if isinstance(artist, str) else ArtistReference.from_dict(artist) for artist in value.get('artists') or []],
+        )
+
+@dataclass(slots=True)
+class PlaylistTracks:
+    playlist_id: str
+    tracks: List[Track]
+    next_offset: Optional[int] = None # Set while the playlist is only partly extracted
+
+    @classmethod
+    def from_dict(cls, value, albums=None, artists=None):
+        return cls(value['playlist_id'], [Track.from_dict(track, albums, artists) for track in value['tracks']], value.get('next_offset'))
+
+@dataclass(slots=True)
+class Artist:
+    id: str
+    name: Optional[str]
+    genres: List[str]
+    popularity: Optional[int]
+    followers_total: Optional[int]
+    images: List[Image]
+
+@dataclass(slots=True)
+class Album:
+    id: str
+    name: Optional[str]
+    album_type: Optional[str]
+    release_date: Optional[str]
+    release_date_precision: Optional[str]
+    total_tracks: Optional[int]
+    label: Optional[str]
+    popularity: Optional[int]
+    artists: List[ArtistReference]
+    images: List[Image]
+
+
+def get_shared_album(album: AlbumReference, albums: Optional[Dict[str, AlbumReference]]) -> AlbumReference:
+    """
+    Returns the album of `albums` with the id of `album`, adding it when it isn't there yet,
+    so the tracks of an album share one AlbumReference and its images.
+    """
+    if albums is None or album.id is None:
+        return album
+
+    return albums.setdefault(album.id, album)
+
+
+###################################################################################
+# Normalised tracks files
+###################################################################################
+
+def get_reference(item):
+    # Without an id there is nothing to look up, so the object stays in the track
+    return item.id if item.id is not None else item
+
+class TracksEncoder:
+    """
+    Turns each PlaylistTracks written to a tracks file into its lines: the albums and
+    artists not written to the file yet, then the playlist with their ids. One encoder
+    per file, a file has to hold the lookups its playlists refer to.
+    """
+
+    def __init__(self):
+        self.album_ids = set()
+        self.artist_ids = set()
+
+    def __call__(self, playlist_tracks: PlaylistTracks) -> Iterator[Dict]:
+        tracks = []
+
+        for track in playlist_tracks.tracks:
+            album = track.album
+
+            if album is not None and album.id is not None and album.id not in self.album_ids:
+                self.album_ids.add(album.id)
+                yield {'album': album}
+
+            for artist in track.artists:
+                if artist.id is not None and artist.id not in self.artist_ids:
+                    self.artist_ids.add(artist.id)
+                    yield {'artist': artist}
+
+            tracks.append({
+                'added_at': track.added_at,
+                'is_local': track.is_local,
+                'id': track.id,
+                'name': track.name,
+                'duration_ms': track.duration_ms,
+                'explicit': track.explicit,
+                'album': get_reference(album) if album is not None else None,
+                'artists': [get_reference(artist) for artist in track.artists],
+            })
+
+        yield {'playlist_id': playlist_tracks.playlist_id, 'tracks': tracks, 'next_offset': playlist_tracks.next_offset}
+
+def iterate_playlists_tracks(values: Iterable[Dict], albums: Optional[Dict[str, AlbumReference]] = None) -> Iterator[PlaylistTracks]:
+    """
+    Rebuilds the PlaylistTracks of the lines of a tracks file, normalised or not. The
+    tracks share one AlbumReference per album, kept in `albums` when it is given, and one
+    ArtistReference per artist.
+    """
+    albums = {} if albums is None else albums
+    artists = {}
+
+    for value in values:
+        if 'album' in value:
+            get_shared_album(AlbumReference.from_dict(value['album']), albums)
+        elif 'artist' in value:
+            artist = ArtistReference.from_dict(value['artist'])
+            artists.setdefault(artist.id, artist)
+        else:
+            yield PlaylistTracks.from_dict(value, albums, artists)
@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+# Upper bounds in ms of the latency histogram of the Spotify calls
+SPOTIFY_LATENCY_BUCKETS_MS = [50, 100, 250, 500, 1000, 2500, 5000]
+
+# Every call is added to all the open stages, so the record of `main` has the totals of the run
+_ACTIVE_STAGES = []
+_ACTIVE_STAGES_LOCK = threading.Lock()
+
+
+def get_peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports it in KB and macOS in bytes
+    return peak_rss / 1024 / 1024 if sys.platform == 'darwin' else peak_rss / 1024
+
+def get_high_water_mark_mb():
+    # VmHWM, the peak RSS since the process started or since the last reset_high_water_mark
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+
+    except OSError:
+        pass
+
+    return None
+
+def reset_high_water_mark():
+    # Writing 5 to clear_refs sets VmHWM to the current RSS, only on Linux
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+
+        return True
+
+    except OSError:
+        return False
+
+class StageTelemetry:
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.spotify = {
+            'calls': 0,
+            'status_304': 0,
+            'status_429': 0,
+            'errors': 0,
+            'bytes_downloaded': 0,
+            'seconds': 0.0,
+            'latency_histogram_ms': {f'le_{bound}': 0 for bound in SPOTIFY_LATENCY_BUCKETS_MS} | {f'gt_{SPOTIFY_LATENCY_BUCKETS_MS[-1]}': 0},
+        }
+        self.gcs = {'calls': 0, 'seconds': 0.0, 'bytes_uploaded': 0, 'bytes_downloaded': 0}
+        self.bigquery = {'calls': 0, 'seconds': 0.0}
+
+        # Peak RSS of the stage, kept across the resets of the stages opened inside it
+        self.peak_rss_mb = 0.0
+        self.high_water_mark_reset = False
+        self.started_peak_rss_mb = get_peak_rss_mb()
+
+    def get_stage_peak_rss_mb(self):
+        high_water_mark = get_high_water_mark_mb() if self.high_water_mark_reset else None
+
+        if high_water_mark is not None:
+            return max(self.peak_rss_mb, high_water_mark)
+
+        # Without the reset, the process peak only belongs to the stage if it grew during it
+        peak_rss = get_peak_rss_mb()
+        return peak_rss if peak_rss > self.started_peak_rss_mb else None
+
+    def add_spotify_call(self, seconds, status_code, bytes_downloaded):
+        latency_ms = seconds * 1000
+        bucket = next((f'le_{bound}' for bound in SPOTIFY_LATENCY_BUCKETS_MS if latency_ms <= bound), f'gt_{SPOTIFY_LATENCY_BUCKETS_MS[-1]}')
+
+        self.spotify['calls'] += 1
+        self.spotify['seconds'] += seconds
+        self.spotify['bytes_downloaded'] += bytes_downloaded
+        self.spotify['latency_histogram_ms'][bucket] += 1
+
+        if status_code == 304:
+            self.spotify['status_304'] += 1
+        elif status_code == 429:
+            self.spotify['status_429'] += 1
+        elif status_code >= 400:
+            self.spotify['errors'] += 1
+
+    def add_call(self, service, seconds, bytes_uploaded=0, bytes_downloaded=0):
+        counters = getattr(self, service)
+
+        counters['calls'] += 1
+        counters['seconds'] += seconds
+
+        if service == 'gcs':
+            counters['bytes_uploaded'] += bytes_uploaded
+            counters['bytes_downloaded'] += bytes_downloaded
+
+def _add_to_active_stages(add):
+    with _ACTIVE_STAGES_LOCK:
+        for active_stage in _ACTIVE_STAGES:
+            add(active_stage)
+
+def record_spotify_call(seconds, status_code, bytes_downloaded=0):
+    _add_to_active_stages(lambda active_stage: active_stage.add_spotify_call(seconds, status_code, bytes_downloaded))
+
+def record_call(service, seconds, bytes_uploaded=0, bytes_downloaded=0):
+    _add_to_active_stages(lambda active_stage: active_stage.add_call(service, seconds, bytes_uploaded, bytes_downloaded))
+
+def add_rows(count):
+    def add(active_stage):
+        active_stage.rows += count
+
+    _add_to_active_stages(add)
+
+@contextmanager
+def timed_call(service, bytes_uploaded=0, bytes_downloaded=0):
+    """
+    Records the time of the `gcs` or `bigquery` call made inside the block.
+    """
+    started_at = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        record_call(service, time.perf_counter() - started_at, bytes_uploaded, bytes_downloaded)
+
+@contextmanager
+def stage(name):
+    """
+    Collects the calls and rows of the block and logs them as one JSON line when it ends.
+
+    Cloud Logging parses the line into the jsonPayload of the entry, so the fields can be
+    turned into log-based metrics.
+    """
+    telemetry = StageTelemetry(name)
+    status = 'ok'
+    started_at = time.perf_counter()
+
+    with _ACTIVE_STAGES_LOCK:
+        # The open stages keep the peak they reached so far, the reset starts the peak of this one
+        high_water_mark = get_high_water_mark_mb()
+
+        for active_stage in _ACTIVE_STAGES:
+            active_stage.peak_rss_mb = max(active_stage.peak_rss_mb, high_water_mark or 0.0)
+
+        telemetry.high_water_mark_reset = reset_high_water_mark()
+        _ACTIVE_STAGES.append(telemetry)
+
+    try:
+        yield telemetry
+
+    except BaseException:
+        status = 'error'
+        raise
+
+    finally:
+        with _ACTIVE_STAGES_LOCK:
+            _ACTIVE_STAGES.remove(telemetry)
+            stage_peak_rss_mb = telemetry.get_stage_peak_rss_mb()
+
+        print(json.dumps({
+            'severity': 'INFO',
+            'message': f'Telemetry of the stage {name}',
+            'telemetry': {
+                'function': os.getenv('K_SERVICE'),
+                'stage': name,
+                'status': status,
+                'wall_seconds': round(time.perf_counter() - started_at, 3),
+                'rows': telemetry.rows,
+                # None when the peak of the stage can't be told apart from the peak of the process
+                'stage_peak_rss_mb': round(stage_peak_rss_mb, 1) if stage_peak_rss_mb is not None else None,
+                'spotify': {**telemetry.spotify, 'seconds': round(telemetry.spotify['seconds'], 3)},
+                'gcs': {**telemetry.gcs, 'seconds': round(telemetry.gcs['seconds'], 3)},
+                'bigquery': {**telemetry.bigquery, 'seconds': round(telemetry.bigquery['seconds'], 3)},
+            },
+        }))
@@ -0,0 +1,315 @@
+import io
+import os
+import uuid
+import threading
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from datetime import datetime, timedelta, timezone
+from songs_common.gcp import get_bigquery_client, get_bigquery_storage_client, get_bucket
+from songs_common.telemetry import add_rows, timed_call
+
+# merge: only the new and changed rows are written, truncate: the table is rewritten
+LOAD_MODE = os.getenv('LOAD_MODE', 'merge')
+
+# Bucket where the Parquet of each load is staged and loaded from by its URI, otherwise it is sent from memory
+LOAD_STAGING_BUCKET = os.getenv('LOAD_STAGING_BUCKET') or None
+
+STAGING_TABLE_EXPIRATION = timedelta(hours=6)
+
+# Past this many distinct values staged, the merge doesn't filter the table on its clustering column
+MERGE_FILTER_MAX_VALUES = 10_000
+
+# Arrow type of each BigQuery type the loads write
+ARROW_TYPES = {
+    'STRING': pa.string(),
+    'INTEGER': pa.int64(),
+    'INT64': pa.int64(),
+    'FLOAT': pa.float64(),
+    'FLOAT64': pa.float64(),
+    'BOOLEAN': pa.bool_(),
+    'BOOL': pa.bool_(),
+    'DATE': pa.date32(),
+    'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+}
+
+# The schema of each table, read once per process. The tables are created by terraform,
+# so their schema only changes with a deploy, which starts new instances.
+_TABLE_SCHEMAS = {}
+_TABLE_SCHEMAS_LOCK = threading.Lock()
+
+
+###################################################################################
+# Schemas
+###################################################################################
+
+def get_table_schema(dataset_table):
+    with _TABLE_SCHEMAS_LOCK:
+        if dataset_table not in _TABLE_SCHEMAS:
+            with timed_call('bigquery'):
+                _TABLE_SCHEMAS[dataset_table] = get_bigquery_client().get_table(dataset_table).schema
+
+        return _TABLE_SCHEMAS[dataset_table]
+
+def get_arrow_schema(schema):
+    try:
+        # All nullable, the REQUIRED fields are checked by BigQuery when the rows are loaded
+        return pa.schema([pa.field(field.name, ARROW_TYPES[field.field_type]) for field in schema])
+
+    except KeyError as e:
+        raise Exception(f'The BigQuery type {e} has no Arrow type')
+
+def to_arrow_table(data, arrow_schema):
+    """
+    Returns `data`, an Arrow table or a dataframe, with the columns and types of `arrow_schema`.
+    """
+    if isinstance(data, pa.Table):
+        return data.select(arrow_schema.names).cast(arrow_schema)
+
+    return pa.Table.from_pandas(data[arrow_schema.names], schema=arrow_schema, preserve_index=False)
+
+def to_parquet_buffer(table):
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='snappy')
+    buffer.seek(0)
+
+    return buffer
+
+
+###################################################################################
+# Loads
+###################################################################################
+
+def to_string_literal(value):
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+def get_merge_query(dataset_table, staging_table, columns, key_columns, partition_column=None, partition_range=None, has_null_partition=False, cluster_column=None, cluster_values=None):
+    on_conditions = [f'T.{column} IS NOT DISTINCT FROM S.{column}' for column in key_columns]
+
+    # A constant list of the staged values of a clustering column skips the blocks of the other values
+    if cluster_column and cluster_values:
+        on_conditions.append(f"T.{cluster_column} IN ({', '.join(to_string_literal(value) for value in sorted(cluster_values))})")
+
+    # A constant filter on the partitioning column skips the partitions outside the staged range
+    if partition_column and partition_range:
+        first, last = partition_range
+        partition_condition = f"T.{partition_column} BETWEEN TIMESTAMP('{first.isoformat()}') AND TIMESTAMP('{last.isoformat()}')"
+
+        if has_null_partition:
+            partition_condition = f'(T.{partition_column} IS NULL OR {partition_condition})'
+
+        on_conditions.append(partition_condition)
+
+    value_columns = [column for column in columns if column not in key_columns]
+
+    query = f"""
+        MERGE `{dataset_table}` T
+        USING `{staging_table}` S
+        ON {' AND '.join(on_conditions)}
+    """
+
+    if value_columns:
+        query += f"""
+        WHEN MATCHED AND ({' OR '.join(f'T.{column} IS DISTINCT FROM S.{column}' for column in value_columns)}) THEN
+            UPDATE SET {', '.join(f'{column} = S.{column}' for column in value_columns)}
+        """
+
+    query += """
+        WHEN NOT MATCHED THEN
+            INSERT ROW
+    """
+
+    return query
+
+class TableLoader:
+    """
+    Loads Arrow tables or dataframes into `dataset_table` as they are produced, so a table
+    that doesn't fit in memory can be loaded in chunks. Each chunk is sent to BigQuery as
+    Parquet, from memory or staged in LOAD_STAGING_BUCKET.
+
+    In the truncate mode the first chunk rewrites the table and the next ones are appended
+    to it. In the merge mode the chunks are appended to a staging table, which is merged
+    into the table on `key_columns` when the loader is closed: new rows are inserted, rows
+    with other values are updated and the rest of the table is untouched. With
+    `partition_column`, the merge skips the partitions outside the range of the rows
+    staged. With `cluster_column`, a STRING column the table is clustered on, the merge
+    only reads the blocks of the values staged, so the rows the caller doesn't stage are
+    neither rewritten nor read.
+    """
+
+    def __init__(self, dataset_table, key_columns, partition_column=None, cluster_column=None, mode=None):
+        self.dataset_table = dataset_table
+        self.key_columns = key_columns
+        self.partition_column = partition_column
+        self.cluster_column = cluster_column
+        self.mode = mode or LOAD_MODE
+        self.chunks = 0
+        self.rows = 0
+        self._partition_range = None
+        self._has_null_partition = False
+        self._cluster_values = set()
+
+    def __enter__(self):
+        from google.cloud import bigquery # Already imported by get_bigquery_client
+
+        self._bigquery = bigquery
+        self._client = get_bigquery_client()
+
+        try:
+            self._schema = get_table_schema(self.dataset_table)
+            self._arrow_schema = get_arrow_schema(self._schema)
+
+            if self.mode == 'truncate':
+                self._destination = self.dataset_table
+            else:
+                self._destination = f'{self.dataset_table}__staging_{uuid.uuid4().hex[:8]}'
+
+                # Created with its expiration, so if the function dies before the delete it still goes away
+                staging = bigquery.Table(f'{self._client.project}.{self._destination}', schema=self._schema)
+                staging.expires = datetime.now(timezone.utc) + STAGING_TABLE_EXPIRATION
+
+                with timed_call('bigquery'):
+                    self._client.create_table(staging)
+
+        except Exception as e:
+            raise Exception(f'An error occurred while uploading table to BigQuery: {e}')
+
+        return self
+
+    def _load_parquet(self, table):
+        job_config = self._bigquery.LoadJobConfig(
+            source_format='PARQUET',
+            write_disposition='WRITE_TRUNCATE' if self.mode == 'truncate' and self.chunks == 0 else 'WRITE_APPEND',
+            schema=self._schema
+        )
+
+        buffer = to_parquet_buffer(table)
+
+        if LOAD_STAGING_BUCKET is None:
+            with timed_call('bigquery'):
+                job = self._client.load_table_from_file(buffer, self._destination, job_config=job_config)
+                job.result()
+
+            return
+
+        blob = get_bucket(LOAD_STAGING_BUCKET).blob(f'bigquery-loads/{self._destination}/{uuid.uuid4().hex}.parquet')
+
+        with timed_call('gcs', bytes_uploaded=buffer.getbuffer().nbytes):
+            blob.upload_from_file(buffer, content_type='application/vnd.apache.parquet')
+
+        try:
+            with timed_call('bigquery'):
+                job = self._client.load_table_from_uri(f'gs://{LOAD_STAGING_BUCKET}/{blob.name}', self._destination, job_config=job_config)
+                job.result()
+
+        finally:
+            with timed_call('gcs'):
+                blob.delete()
+
+    def append(self, data):
+        try:
+            table = to_arrow_table(data, self._arrow_schema)
+            self._load_parquet(table)
+
+            if self.partition_column:
+                column = table[self.partition_column]
+
+                if column.null_count < len(column):
+                    bounds = pc.min_max(column)
+                    first, last = bounds['min'].as_py(), bounds['max'].as_py()
+
+                    if self._partition_range is not None:
+                        first, last = min(first, self._partition_range[0]), max(last, self._partition_range[1])
+
+                    self._partition_range = (first, last)
+
+                self._has_null_partition = self._has_null_partition or column.null_count > 0
+
+            # None once a null is staged or there are too many values to filter on
+            if self.cluster_column and self._cluster_values is not None:
+                column = table[self.cluster_column]
+
+                if column.null_count:
+                    self._cluster_values = None
+                else:
+                    self._cluster_values.update(pc.unique(column).to_pylist())
+
+                    if len(self._cluster_values) > MERGE_FILTER_MAX_VALUES:
+                        self._cluster_values = None
+
+            self.chunks += 1
+            self.rows += table.num_rows
+            add_rows(table.num_rows)
+
+        except Exception as e:
+            raise Exception(f'An error occurred while uploading table to BigQuery: {e}')
+
+    def _delete_staging_table(self):
+        if self._destination != self.dataset_table:
+            with timed_call('bigquery'):
+                self._client.delete_table(self._destination, not_found_ok=True)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._destination == self.dataset_table:
+            if exc_type is None:
+                print(f'Table uploaded to the BigQuery table: {self.dataset_table} ({self.rows} rows in {self.chunks} chunks)')
+
+            return False
+
+        try:
+            # Nothing staged, nothing to merge
+            if exc_type is None and self.rows:
+                query = get_merge_query(
+                    self.dataset_table,
+                    self._destination,
+                    [field.name for field in self._schema],
+                    self.key_columns,
+                    partition_column=self.partition_column,
+                    partition_range=self._partition_range,
+                    has_null_partition=self._has_null_partition,
+                    cluster_column=self.cluster_column,
+                    cluster_values=self._cluster_values,
+                )
+
+                with timed_call('bigquery'):
+                    query_job = self._client.query(query)
+                    query_job.result()
+
+                print(f'Table merged into the BigQuery table: {self.dataset_table} ({query_job.num_dml_affected_rows} rows affected)')
+
+        except Exception as e:
+            raise Exception(f'An error occurred while uploading table to BigQuery: {e}')
+
+        finally:
+            self._delete_staging_table()
+
+        return False
+
+def upload_table_to_bigquery(data, dataset_table, key_columns, partition_column=None, mode=None):
+    """
+    Loads `data`, an Arrow table or a dataframe, into `dataset_table` as a single chunk of a TableLoader.
+    """
+    with TableLoader(dataset_table, key_columns, partition_column=partition_column, mode=mode) as loader:
+        loader.append(data)
+
+def read_bigquery_table(dataset_table, columns):
+    """
+    Reads only `columns` of `dataset_table` as an Arrow table.
+
+    The rows are streamed through the BigQuery Storage Read API, which doesn't run a query
+    job and reads only the selected columns.
+    """
+    client = get_bigquery_client()
+
+    try:
+        selected_fields = [field for field in get_table_schema(dataset_table) if field.name in columns]
+
+        with timed_call('bigquery'):
+            rows = client.list_rows(dataset_table, selected_fields=selected_fields)
+            arrow_table = rows.to_arrow(bqstorage_client=get_bigquery_storage_client())
+
+        print(f'{arrow_table.num_rows} rows read from the BigQuery table: {dataset_table}')
+        return arrow_table.select(columns)
+
+    except Exception as e:
+        raise Exception(f'An error occurred while reading the BigQuery table {dataset_table}: {e}')
@@ -12,7 +12,8 @@ resource "google_project_service" "required_apis" {
         "run.googleapis.com",
         "workflowexecutions.googleapis.com",
         "cloudbuild.googleapis.com",
-        "artifactregistry.googleapis.com"
+        "artifactregistry.googleapis.com",
+        "bigquerystorage.googleapis.com"
     ])
 
     project = var.project
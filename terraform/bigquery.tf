@@ -11,6 +11,10 @@ resource "google_bigquery_table" "fact_songs" {
     table_id   = "fact_songs"
     description = "Fact table for songs added to playlists"
     clustering = [ "dim_platform_id", "dim_playlist_id", "dim_user_id" ]
+    time_partitioning {
+        type = "DAY"
+        field = "added_at"
+    }
     schema = <<SCHEMA
     [
         {
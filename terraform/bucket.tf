@@ -5,6 +5,17 @@ resource "google_storage_bucket" "landing_bucket" {
     force_destroy = true
     uniform_bucket_level_access = true
 
+    # Checkpoints left by extractions that never finished
+    lifecycle_rule {
+        condition {
+            age = 3
+            matches_prefix = ["spotify/checkpoints/"]
+        }
+        action {
+            type = "Delete"
+        }
+    }
+
     depends_on = [
         google_project_service.required_apis["storage.googleapis.com"]
     ]
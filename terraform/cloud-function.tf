@@ -1,6 +1,30 @@
+locals {
+    # songs_common is shared by the functions, so it is added to each zip next to the function code
+    songs_common_dir = "${path.module}/../cloud-functions/songs_common"
+    cloud_function_source_files = "{*.py,requirements.txt}"
+
+    extract_timeout_seconds = 400
+}
+
 data "archive_file" "extract_function_zip" {
     type = "zip"
-    source_dir = "${path.module}/../cloud-functions/cf_extract"
+
+    dynamic "source" {
+        for_each = fileset("${path.module}/../cloud-functions/cf_extract", local.cloud_function_source_files)
+        content {
+            content = file("${path.module}/../cloud-functions/cf_extract/${source.value}")
+            filename = source.value
+        }
+    }
+
+    dynamic "source" {
+        for_each = fileset(local.songs_common_dir, "*.py")
+        content {
+            content = file("${local.songs_common_dir}/${source.value}")
+            filename = "songs_common/${source.value}"
+        }
+    }
+
     output_path = "${path.module}/deploy/cf_extract.zip"
 }
 
@@ -34,18 +58,29 @@ resource "google_cloudfunctions2_function" "extract_cloud_function" {
     }
 
     service_config {
-        max_instance_count = 1
+        # One instance per shard, the workflow invokes the shards at the same time
+        max_instance_count = var.extract_shard_count
         available_memory = "256M"
-        timeout_seconds = 400
+        timeout_seconds = local.extract_timeout_seconds
         service_account_email = google_service_account.cloud_functions_service_account.email
         environment_variables = {
             PROJECT_ID = "${var.project}"
             SONGS_SECRET_NAME = "${var.songs_secret_manager_name}"
+            DATASET_ID = google_bigquery_dataset.prep_songs_dimensions.dataset_id
+            TABLE_ID = google_bigquery_table.dim_user.table_id
+            # The extraction stops a minute before the timeout to save its checkpoint
+            EXTRACT_TIME_BUDGET_SECONDS = local.extract_timeout_seconds - 60
+            SPOTIFY_MAX_WORKERS = "${var.spotify_max_workers}"
+            SPOTIFY_CACHE_MAX_MB = "${var.spotify_cache_max_mb}"
+            SPOTIFY_CACHE_TTL_HOURS = "${var.spotify_cache_ttl_hours}"
         }
     }
 
     depends_on = [
-        google_project_service.required_apis["cloudfunctions.googleapis.com"]
+        google_project_service.required_apis["cloudfunctions.googleapis.com"],
+        google_project_service.required_apis["bigquerystorage.googleapis.com"],
+        google_bigquery_dataset.prep_songs_dimensions,
+        google_bigquery_table.dim_user
     ]
 }
 
@@ -57,7 +92,23 @@ resource "google_cloudfunctions2_function" "extract_cloud_function" {
 
 data "archive_file" "transform_function_zip" {
     type = "zip"
-    source_dir = "${path.module}/../cloud-functions/cf_transform"
+
+    dynamic "source" {
+        for_each = fileset("${path.module}/../cloud-functions/cf_transform", local.cloud_function_source_files)
+        content {
+            content = file("${path.module}/../cloud-functions/cf_transform/${source.value}")
+            filename = source.value
+        }
+    }
+
+    dynamic "source" {
+        for_each = fileset(local.songs_common_dir, "*.py")
+        content {
+            content = file("${local.songs_common_dir}/${source.value}")
+            filename = "songs_common/${source.value}"
+        }
+    }
+
     output_path = "${path.module}/deploy/cf_transform.zip"
 }
 
@@ -97,6 +148,9 @@ resource "google_cloudfunctions2_function" "transform_cloud_function" {
         timeout_seconds = 400
         environment_variables = {
             PROJECT_ID = "${var.project}"
+            LOAD_MODE = "${var.load_mode}"
+            FACT_MEMORY_CEILING_MB = "${var.fact_memory_ceiling_mb}"
+            LOAD_STAGING_BUCKET = "${var.load_staging_bucket}"
             DATASET_ID = google_bigquery_dataset.prep_songs_facts.dataset_id
             TABLE_ID = google_bigquery_table.fact_songs.table_id
         }
@@ -115,7 +169,23 @@ resource "google_cloudfunctions2_function" "transform_cloud_function" {
 
 data "archive_file" "create_artists_dimensions_zip" {
     type = "zip"
-    source_dir = "${path.module}/../cloud-functions/cf_create_artists_dimension"
+
+    dynamic "source" {
+        for_each = fileset("${path.module}/../cloud-functions/cf_create_artists_dimension", local.cloud_function_source_files)
+        content {
+            content = file("${path.module}/../cloud-functions/cf_create_artists_dimension/${source.value}")
+            filename = source.value
+        }
+    }
+
+    dynamic "source" {
+        for_each = fileset(local.songs_common_dir, "*.py")
+        content {
+            content = file("${local.songs_common_dir}/${source.value}")
+            filename = "songs_common/${source.value}"
+        }
+    }
+
     output_path = "${path.module}/deploy/cf_create_artists_dimension.zip"
 }
 
@@ -155,6 +225,7 @@ resource "google_cloudfunctions2_function" "create_artists_dimension_function" {
         timeout_seconds = 400
         environment_variables = {
             PROJECT_ID = "${var.project}"
+            LOAD_MODE = "${var.load_mode}"
             DATASET_ID = google_bigquery_dataset.prep_songs_dimensions.dataset_id
             TABLE_ID = google_bigquery_table.dim_artist.table_id
         }
@@ -173,7 +244,23 @@ resource "google_cloudfunctions2_function" "create_artists_dimension_function" {
 
 data "archive_file" "create_platforms_dimension_zip" {
     type = "zip"
-    source_dir = "${path.module}/../cloud-functions/cf_create_plataforms_dimension"
+
+    dynamic "source" {
+        for_each = fileset("${path.module}/../cloud-functions/cf_create_plataforms_dimension", local.cloud_function_source_files)
+        content {
+            content = file("${path.module}/../cloud-functions/cf_create_plataforms_dimension/${source.value}")
+            filename = source.value
+        }
+    }
+
+    dynamic "source" {
+        for_each = fileset(local.songs_common_dir, "*.py")
+        content {
+            content = file("${local.songs_common_dir}/${source.value}")
+            filename = "songs_common/${source.value}"
+        }
+    }
+
     output_path = "${path.module}/deploy/cf_create_platforms_dimension.zip"
 }
 
@@ -213,6 +300,7 @@ resource "google_cloudfunctions2_function" "create_platforms_dimension_function"
         timeout_seconds = 400
         environment_variables = {
             PROJECT_ID = "${var.project}"
+            LOAD_MODE = "${var.load_mode}"
             DATASET_ID = google_bigquery_dataset.prep_songs_dimensions.dataset_id
             TABLE_ID = google_bigquery_table.dim_platform.table_id
         }
@@ -231,7 +319,23 @@ resource "google_cloudfunctions2_function" "create_platforms_dimension_function"
 
 data "archive_file" "create_playlists_dimension_zip" {
     type = "zip"
-    source_dir = "${path.module}/../cloud-functions/cf_create_playlists_dimension"
+
+    dynamic "source" {
+        for_each = fileset("${path.module}/../cloud-functions/cf_create_playlists_dimension", local.cloud_function_source_files)
+        content {
+            content = file("${path.module}/../cloud-functions/cf_create_playlists_dimension/${source.value}")
+            filename = source.value
+        }
+    }
+
+    dynamic "source" {
+        for_each = fileset(local.songs_common_dir, "*.py")
+        content {
+            content = file("${local.songs_common_dir}/${source.value}")
+            filename = "songs_common/${source.value}"
+        }
+    }
+
     output_path = "${path.module}/deploy/cf_create_playlists_dimension.zip"
 }
 
@@ -271,6 +375,7 @@ resource "google_cloudfunctions2_function" "create_playlists_dimension_function"
         timeout_seconds = 400
         environment_variables = {
             PROJECT_ID = "${var.project}"
+            LOAD_MODE = "${var.load_mode}"
             DATASET_ID = google_bigquery_dataset.prep_songs_dimensions.dataset_id
             TABLE_ID = google_bigquery_table.dim_playlist.table_id
         }
@@ -289,7 +394,23 @@ resource "google_cloudfunctions2_function" "create_playlists_dimension_function"
 
 data "archive_file" "create_tracks_dimension_zip" {
     type = "zip"
-    source_dir = "${path.module}/../cloud-functions/cf_create_tracks_dimension"
+
+    dynamic "source" {
+        for_each = fileset("${path.module}/../cloud-functions/cf_create_tracks_dimension", local.cloud_function_source_files)
+        content {
+            content = file("${path.module}/../cloud-functions/cf_create_tracks_dimension/${source.value}")
+            filename = source.value
+        }
+    }
+
+    dynamic "source" {
+        for_each = fileset(local.songs_common_dir, "*.py")
+        content {
+            content = file("${local.songs_common_dir}/${source.value}")
+            filename = "songs_common/${source.value}"
+        }
+    }
+
     output_path = "${path.module}/deploy/cf_create_tracks_dimension.zip"
 }
 
@@ -329,6 +450,7 @@ resource "google_cloudfunctions2_function" "create_tracks_dimension_function" {
         timeout_seconds = 400
         environment_variables = {
             PROJECT_ID = "${var.project}"
+            LOAD_MODE = "${var.load_mode}"
             DATASET_ID = google_bigquery_dataset.prep_songs_dimensions.dataset_id
             TABLE_ID = google_bigquery_table.dim_track.table_id
         }
@@ -340,3 +462,81 @@ resource "google_cloudfunctions2_function" "create_tracks_dimension_function" {
         google_bigquery_table.dim_track
     ]
 }
+
+###################################################################################################################
+# CREATE DIMENSIONS
+###################################################################################################################
+
+data "archive_file" "create_dimensions_zip" {
+    type = "zip"
+
+    dynamic "source" {
+        for_each = fileset("${path.module}/../cloud-functions/cf_create_dimensions", local.cloud_function_source_files)
+        content {
+            content = file("${path.module}/../cloud-functions/cf_create_dimensions/${source.value}")
+            filename = source.value
+        }
+    }
+
+    dynamic "source" {
+        for_each = fileset(local.songs_common_dir, "*.py")
+        content {
+            content = file("${local.songs_common_dir}/${source.value}")
+            filename = "songs_common/${source.value}"
+        }
+    }
+
+    output_path = "${path.module}/deploy/cf_create_dimensions.zip"
+}
+
+resource "google_storage_bucket_object" "create_dimensions_object" {
+    source = data.archive_file.create_dimensions_zip.output_path
+    content_type = "application/zip"
+    name = "create-dimensions-${data.archive_file.create_dimensions_zip.output_md5}.zip"
+    bucket = google_storage_bucket.cloud_functions_bucket.name
+    depends_on = [
+        google_storage_bucket.cloud_functions_bucket,
+        data.archive_file.create_dimensions_zip
+    ]
+}
+
+# Builds all the dimensions in one pass, the functions of each dimension are kept to rebuild a single one
+resource "google_cloudfunctions2_function" "create_dimensions_function" {
+    name = "create-dimensions"
+    location = var.region
+    project = var.project
+    description = "Cloud function to create all the dimensions in BigQuery"
+
+    build_config {
+        runtime = "python312"
+        entry_point = "main"
+
+        source {
+            storage_source {
+                bucket = google_storage_bucket.cloud_functions_bucket.name
+                object = google_storage_bucket_object.create_dimensions_object.name
+            }
+        }
+    }
+
+    service_config {
+        max_instance_count = 1
+        available_memory   = "1Gi"
+        available_cpu      = "0.583"
+        timeout_seconds = 400
+        environment_variables = {
+            PROJECT_ID = "${var.project}"
+            LOAD_MODE = "${var.load_mode}"
+            DATASET_ID = google_bigquery_dataset.prep_songs_dimensions.dataset_id
+        }
+    }
+
+    depends_on = [
+        google_project_service.required_apis["cloudfunctions.googleapis.com"],
+        google_bigquery_dataset.prep_songs_dimensions,
+        google_bigquery_table.dim_platform,
+        google_bigquery_table.dim_artist,
+        google_bigquery_table.dim_track,
+        google_bigquery_table.dim_playlist
+    ]
+}
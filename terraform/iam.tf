@@ -41,6 +41,7 @@ resource "google_project_iam_member" "cloud_functions_service_account_roles" {
         "roles/secretmanager.secretAccessor",
         "roles/bigquery.dataEditor",
         "roles/bigquery.jobUser",
+        "roles/bigquery.readSessionUser",
         "roles/storage.admin",
         "roles/storage.objectAdmin"
     ])
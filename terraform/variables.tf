@@ -13,3 +13,43 @@ variable "region" {
 variable "songs_secret_manager_name" {
     description = "Name of the secret manager used in the cloud function extract"
 }
+
+variable "spotify_max_workers" {
+    description = "Number of concurrent requests the cloud function extract makes to the Spotify API"
+    default = 8
+}
+
+variable "spotify_cache_max_mb" {
+    description = "Memory in MB of the Spotify responses cache of the cloud function extract, 0 disables it"
+    default = 32
+}
+
+variable "spotify_cache_ttl_hours" {
+    description = "Hours a Spotify response not requested again is kept in the cache"
+    default = 168
+}
+
+variable "extract_shard_count" {
+    description = "Number of shards of users the extraction is split into, each shard runs in its own instance of the cloud function extract"
+    default = 4
+}
+
+variable "extract_max_invocations" {
+    description = "Times the workflow invokes the cloud function extract for a shard while it reports that the extraction is incomplete"
+    default = 10
+}
+
+variable "load_mode" {
+    description = "How the tables are loaded into BigQuery: merge (only new and changed rows) or truncate (full rewrite)"
+    default = "merge"
+}
+
+variable "fact_memory_ceiling_mb" {
+    description = "Memory in MB a chunk of the fact takes while the cloud function transform builds it, 0 builds the fact in one chunk"
+    default = 256
+}
+
+variable "load_staging_bucket" {
+    description = "Bucket where the cloud function transform stages the Parquet of its BigQuery loads, empty sends them from memory"
+    default = ""
+}
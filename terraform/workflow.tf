@@ -11,59 +11,82 @@ resource "google_workflows_workflow" "songs_etl_workflow" {
     main:
         params: [input]
         steps:
-        - extract:
-            call: http.post
-            args:
-                url: "${google_cloudfunctions2_function.extract_cloud_function.service_config[0].uri}"
-                auth:
-                    type: OIDC
-            result: extract_response
-        - logExtractResponse:
-            call: sys.log
-            args:
-                text: "$${extract_response.body}"
-        - createDimensions:
+        # A backfill rebuilds the warehouse from the days already landed, without extracting,
+        # e.g. {"backfill": {"start_date": "2024-01-01", "end_date": "2024-01-31"}}
+        - init:
+            assign:
+                - backfill: $${map.get(input, "backfill")}
+        - checkBackfill:
+            switch:
+                - condition: $${backfill != null}
+                  next: initTransformResponse
+        # Each shard extracts the users whose spotify_id hashes to its index, in its own instance.
+        # The extraction saves a checkpoint and answers "incomplete" when its time budget runs out,
+        # each new invocation of the shard resumes from its checkpoint.
+        - extractShards:
             parallel:
-                branches:
-                - createArtistsDimension:
+                for:
+                    value: shard_index
+                    range: [0, ${var.extract_shard_count - 1}]
                     steps:
-                    - createArtistsDimensionCall:
+                    - initExtractInvocations:
+                        assign:
+                            - extract_invocations: 0
+                    - extract:
                         call: http.post
                         args:
-                            url: "${google_cloudfunctions2_function.create_artists_dimension_function.service_config[0].uri}"
+                            url: "${google_cloudfunctions2_function.extract_cloud_function.service_config[0].uri}"
                             auth:
                                 type: OIDC
-                - createPlatformsDimension:
-                    steps:
-                    - createPlatformsDimensionCall:
-                        call: http.post
+                            body:
+                                shard:
+                                    index: $${shard_index}
+                                    count: ${var.extract_shard_count}
+                            timeout: 1800
+                        retry: $${http.default_retry}
+                        result: extract_response
+                    - logExtractResponse:
+                        call: sys.log
                         args:
-                            url: "${google_cloudfunctions2_function.create_platforms_dimension_function.service_config[0].uri}"
-                            auth:
-                                type: OIDC
-                - createPlaylistsDimension:
+                            text: $${"Shard " + string(shard_index) + ": " + json.encode_to_string(extract_response.body)}
+                    - checkExtractStatus:
+                        switch:
+                            - condition: $${extract_response.body.status == "incomplete" and extract_invocations + 1 < ${var.extract_max_invocations}}
+                              assign:
+                                  - extract_invocations: $${extract_invocations + 1}
+                              next: extract
+                            - condition: $${extract_response.body.status == "incomplete"}
+                              raise: $${"The extraction of the shard " + string(shard_index) + " is still incomplete after ${var.extract_max_invocations} invocations"}
+        - initTransformResponse:
+            assign:
+                - transform_response: null
+        # The surrogate keys are computed from the Spotify ids, so the fact doesn't wait for the dimensions
+        # All the dimensions are built by one function that reads the landing data once
+        - createDimensionsAndFact:
+            parallel:
+                shared: [transform_response]
+                branches:
+                - createDimensions:
                     steps:
-                    - createPlaylistsDimensionCall:
+                    - createDimensionsCall:
                         call: http.post
                         args:
-                            url: "${google_cloudfunctions2_function.create_playlists_dimension_function.service_config[0].uri}"
+                            url: "${google_cloudfunctions2_function.create_dimensions_function.service_config[0].uri}"
                             auth:
                                 type: OIDC
-                - createTracksDimension:
+                            body:
+                                backfill: $${backfill}
+                - transform:
                     steps:
-                    - createTracksDimensionCall:
+                    - transformCall:
                         call: http.post
                         args:
-                            url: "${google_cloudfunctions2_function.create_tracks_dimension_function.service_config[0].uri}"
+                            url: "${google_cloudfunctions2_function.transform_cloud_function.service_config[0].uri}"
                             auth:
                                 type: OIDC
-        - transform:
-            call: http.post
-            args:
-                url: "${google_cloudfunctions2_function.transform_cloud_function.service_config[0].uri}"
-                auth:
-                    type: OIDC
-            result: transform_response
+                            body:
+                                backfill: $${backfill}
+                        result: transform_response
         - logTransformResponse:
             call: sys.log
             args:
@@ -74,9 +97,6 @@ resource "google_workflows_workflow" "songs_etl_workflow" {
         google_project_service.required_apis["workflowexecutions.googleapis.com"],
         google_cloudfunctions2_function.extract_cloud_function,
         google_cloudfunctions2_function.transform_cloud_function,
-        google_cloudfunctions2_function.create_artists_dimension_function,
-        google_cloudfunctions2_function.create_platforms_dimension_function,
-        google_cloudfunctions2_function.create_playlists_dimension_function,
-        google_cloudfunctions2_function.create_tracks_dimension_function,
+        google_cloudfunctions2_function.create_dimensions_function,
     ]
 }
\ No newline at end of file